@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for bufr_functions.bits_to_n. For each width, the time needed to convert an array of bit sequences is compared with that of the
+original implementation, which rebuilt a list with powers of 2 on every call and summed the products over the last dimension.
+
+Usage: python benchmarks/bench_bits_to_n.py [n_values]
+"""
+import sys
+import timeit
+import numpy as np
+
+from numpy_bufr import bufr_functions as bf
+
+
+
+def bits_to_n_original(bits,signed=False):
+    if signed:
+        return -2*(bits[...,0]-0.5)*np.sum(bits[...,1:]*np.array([2**j for j in reversed(range(0,bits.shape[-1]-1))]),axis=-1)
+    else:
+        return np.sum(bits*np.array([2**j for j in reversed(range(0,bits.shape[-1]))]),axis=-1)
+    
+def best_time(function, repeat=5):
+    n = 3
+    return min(timeit.repeat(function, number=n, repeat=repeat))/n
+    
+def run(n_values=100000, widths=(1, 4, 7, 8, 12, 13, 16, 24, 25, 32, 48, 63)):
+    rng = np.random.default_rng(0)
+    print('%6s %8s %14s %14s %8s' % ('width', 'signed', 'original (ms)', 'bits_to_n (ms)', 'speedup'))
+    for width in widths:
+        bits = rng.integers(0, 2, (n_values, width), dtype='uint8')
+        for signed in (False, True):
+            t_original = best_time(lambda: bits_to_n_original(bits, signed))
+            t_new = best_time(lambda: bf.bits_to_n(bits, signed))
+            print('%6d %8s %14.3f %14.3f %8.1f' % (width, signed, 1e3*t_original, 1e3*t_new, t_original/t_new))
+    
+    #The original implementation overflows for more than 63 bits, so only the new implementation is timed here
+    for width in (64, 96, 128):
+        bits = rng.integers(0, 2, (n_values//10, width), dtype='uint8')
+        print('%6d %8s %14s %14.3f %8s' % (width, False, '-', 1e3*best_time(lambda: bf.bits_to_n(bits)), '-'))
+        
+    
+    
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:]))
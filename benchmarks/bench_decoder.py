@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the complete decoder, using synthetic messages (see synthetic_bufr.py). The cases cover messages of different sizes, nesting depths
+of the loops, delayed and fixed replication, many descriptors outside loops, compressed data, files with many messages, and files that are
+compressed with bz2 or gzip.
+
+For each case the time of each stage of the pipeline is measured:
+    scan: finding the messages in uncompressed content (DecodeBUFR.get_messages_in_BUFR_file)
+    sections: dividing messages into sections and decoding the metadata in sections 0, 1 and 3
+    tables: loading the tables (which are loaded only once per process, so this is the time needed to look them up)
+    plan: obtaining the decode plan (which is compiled only for the first message with a template, see decode_plan.py)
+    section4: decoding the data in section 4
+    other: the remainder, which includes decompressing and extracting messages from compressed files
+The stage times are those of the fastest of the repeated runs. first_run gives the total time of the first run, in which the decode plan still needs
+to be compiled. peak_memory gives the peak of the memory allocated while decoding (including the results), as measured with tracemalloc.
+
+The results are printed, and written to a JSON file together with information about the machine, such that runs can be compared. Usage:
+    python benchmarks/bench_decoder.py [-o results.json] [-r repeat] [-c case_name ...] [--compare earlier_results.json]
+"""
+import argparse
+import bz2
+import collections
+import datetime
+import gzip
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from numpy_bufr import decode_bufr
+from numpy_bufr import decode_plan
+from numpy_bufr.tables import table_cache
+
+import synthetic_bufr as synth
+
+
+
+def get_cases():
+    """Returns an ordered dictionary with a function for each case, that returns the content of a file.
+    """
+    cases = collections.OrderedDict()
+    cases['radar_small'] = lambda: synth.radar_message((10, 100))
+    cases['radar_medium'] = lambda: synth.radar_message((90, 500))
+    cases['radar_large'] = lambda: synth.radar_message((360, 1000))
+    cases['depth1'] = lambda: synth.radar_message((50000,))
+    cases['depth3'] = lambda: synth.radar_message((10, 36, 250))
+    cases['fixed_depth2'] = lambda: synth.radar_message((100, 250), delayed=False)
+    cases['fixed_depth3'] = lambda: synth.radar_message((10, 36, 250), delayed=False)
+    cases['outside_loops_2000'] = lambda: synth.outside_loops_message(2000)
+    cases['compressed_1000_subsets'] = lambda: synth.compressed_message(1000)
+    cases['multi_100_messages'] = lambda: b''.join(synth.radar_message((10, 100), seed=i) for i in range(100))
+    cases['bz2_radar_medium'] = lambda: bz2.compress(synth.radar_message((90, 500)))
+    cases['gzip_radar_medium'] = lambda: gzip.compress(synth.radar_message((90, 500)))
+    cases['bz2_multi_100_messages'] = lambda: bz2.compress(cases['multi_100_messages']())
+    return cases
+
+class TimedDecodeBUFR(decode_bufr.DecodeBUFR):
+    """DecodeBUFR in which the time spent in each stage of the pipeline is accumulated in self.times.
+    """
+    stages = {'get_messages_in_BUFR_file':'scan', 'get_metadata_and_divide_BUFR_message_into_sections':'sections', 'load_tables':'tables',
+              'get_decode_plan':'plan', 'decode_section4':'section4'}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.times = collections.defaultdict(float)
+        for method, stage in self.stages.items():
+            setattr(self, method, self.timed(getattr(self, method), stage))
+
+    def timed(self, function, stage):
+        def timed_function(*args, **kwargs):
+            t = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.times[stage] += time.perf_counter()-t
+            return result
+        return timed_function
+
+def run_case(decoder, content, repeat=5):
+    decode_plan.plans.plans.clear()
+    t = time.perf_counter()
+    metadata = decoder(content)[0]
+    first_run = time.perf_counter()-t
+
+    best = None
+    for i in range(repeat):
+        decoder.times.clear()
+        t = time.perf_counter()
+        decoder(content)
+        total = time.perf_counter()-t
+        if best is None or total < best['total']:
+            stages = {stage: decoder.times[stage] for stage in TimedDecodeBUFR.stages.values()}
+            stages['other'] = max(total-sum(stages.values()), 0.)
+            best = {'total':total, 'stages':stages}
+
+    tracemalloc.start()
+    decoder(content)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'n_bytes':len(content), 'n_messages':len(metadata), 'first_run':first_run, 'total':best['total'], 'stages':best['stages'],
+            'peak_memory':peak_memory}
+
+def get_machine_info():
+    return {'date':datetime.datetime.now().isoformat(timespec='seconds'), 'platform':platform.platform(), 'processor':platform.processor(),
+            'machine':platform.machine(), 'cpu_count':os.cpu_count(), 'python':platform.python_version(), 'numpy':np.__version__}
+
+def print_results(results, earlier=None):
+    stage_names = list(TimedDecodeBUFR.stages.values())+['other']
+    print('%-24s %8s %10s' % ('case', 'messages', 'total (ms)') + ''.join(' %9s' % s for s in stage_names) + ' %10s' % 'peak (MB)' +
+          (' %8s' % 'vs. old' if earlier else ''))
+    for name, r in results.items():
+        line = '%-24s %8d %10.2f' % (name, r['n_messages'], 1e3*r['total']) + ''.join(' %9.2f' % (1e3*r['stages'][s]) for s in stage_names)
+        line += ' %10.2f' % (r['peak_memory']/2**20)
+        if earlier:
+            #Ratio of the earlier total time to the current one, so > 1 means that the decoder has become faster
+            line += ' %8s' % ('%.2f' % (earlier[name]['total']/r['total']) if name in earlier else '-')
+        print(line)
+
+def run(output='bench_decoder.json', repeat=5, case_names=None, compare=None):
+    cases = get_cases()
+    for name in case_names or cases:
+        if not name in cases:
+            raise Exception('Unknown case '+name+', choose from '+', '.join(cases))
+    
+    #Tables for the synthetic messages are written to a temporary directory (removed afterwards), and are not stored in the on-disk table cache
+    table_cache.cache_path = None
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory(prefix='numpy_bufr_bench_') as tmp_dir:
+        decoder = TimedDecodeBUFR(synth.make_tables(tmp_dir), 'eccodes')
+        for name in case_names or cases:
+            results[name] = run_case(decoder, cases[name](), repeat)
+
+    earlier = None
+    if compare:
+        with open(compare) as f:
+            earlier = json.load(f)['cases']
+    print_results(results, earlier)
+
+    with open(output, 'w') as f:
+        json.dump({'machine':get_machine_info(), 'repeat':repeat, 'cases':results}, f, indent=1)
+    print('Results written to '+output)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the decoder with synthetic BUFR messages.')
+    parser.add_argument('-o', '--output', default='bench_decoder.json', help='JSON file to which the results are written')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed runs per case')
+    parser.add_argument('-c', '--cases', nargs='+', help='names of the cases to run (by default all cases)')
+    parser.add_argument('--compare', help='JSON file with earlier results, to which the total times are compared')
+    args = parser.parse_args()
+    run(args.output, args.repeat, args.cases, args.compare)
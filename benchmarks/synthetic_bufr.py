@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Generation of synthetic BUFR messages (and a minimal set of ecCodes tables to decode them), for benchmarking the decoder without depending on
+real data files.
+
+The messages resemble radar data: A header with station, date, time and location, followed by nested replications of reflectivity and radial
+velocity. The nesting depth, the size of each level, and the type of replication (delayed or fixed) can be chosen. In addition messages can be
+generated with many descriptors outside loops, and with compressed data for many subsets.
+The data is packed with numpy for all iterations of a loop at once, such that large messages can be generated quickly.
+"""
+import os
+import numpy as np
+
+
+
+element_table = """#code|abbreviation|type|name|unit|scale|reference|width|crex_unit|crex_scale|crex_width
+001001|blockNumber|long|WMO BLOCK NUMBER|Numeric|0|0|7|Numeric|0|2
+001002|stationNumber|long|WMO STATION NUMBER|Numeric|0|0|10|Numeric|0|3
+004001|year|long|YEAR|a|0|0|12|a|0|4
+004002|month|long|MONTH|mon|0|0|4|mon|0|2
+004003|day|long|DAY|d|0|0|6|d|0|2
+004004|hour|long|HOUR|h|0|0|5|h|0|2
+004005|minute|long|MINUTE|min|0|0|6|min|0|2
+005001|latitude|double|LATITUDE (HIGH ACCURACY)|deg|5|-9000000|25|deg|5|7
+006001|longitude|double|LONGITUDE (HIGH ACCURACY)|deg|5|-18000000|26|deg|5|8
+012101|airTemperature|double|TEMPERATURE/AIR TEMPERATURE|K|2|0|16|C|2|4
+021001|horizontalReflectivity|long|HORIZONTAL REFLECTIVITY|dB|0|-64|7|dB|0|3
+021014|dopplerMeanVelocity|double|DOPPLER MEAN VELOCITY (RADIAL)|m s-1|1|-4096|13|m s-1|1|4
+031001|delayedDescriptorReplicationFactor|long|DELAYED DESCRIPTOR REPLICATION FACTOR|Numeric|0|0|8|Numeric|0|3
+031002|extendedDelayedDescriptorReplicationFactor|long|EXTENDED DELAYED DESCRIPTOR REPLICATION FACTOR|Numeric|0|0|16|Numeric|0|5
+"""
+sequence_table = """"301001" = [  001001, 001002 ]
+"301011" = [  004001, 004002, 004003 ]
+"301012" = [  004004, 004005 ]
+"""
+operator_table = """#code|abbreviation|type|name|unit|scale|reference|width|crex_unit|crex_scale|crex_width
+201YYY|changeDataWidth|long|Change data width|OPERATOR|0|0|0|0|0|
+"""
+datacat_table = """#code|meaning
+6|Radar data
+"""
+
+master_version = 14
+center = 78
+
+def make_tables(base_path):
+    """Write the tables for the synthetic messages in ecCodes format to base_path, which can then be used as table_path (with table_type
+    'eccodes').
+    """
+    master_path = os.path.join(base_path, '0', 'wmo', str(master_version))
+    os.makedirs(os.path.join(master_path, 'codetables'), exist_ok=True)
+    for path, content in ((os.path.join(master_path, 'element.table'), element_table), (os.path.join(master_path, 'sequence.def'), sequence_table),
+                          (os.path.join(base_path, 'operators.table'), operator_table), (os.path.join(base_path, 'datacat.table'), datacat_table)):
+        with open(path, 'w') as f:
+            f.write(content)
+    return base_path
+
+
+
+def to_bits(values, width):
+    """Returns an uint8 array with shape values.shape+(width,), with the bits of the (non-negative) integers in values, most significant bit first.
+    """
+    values = np.asarray(values, dtype='uint64')
+    shifts = np.arange(width-1, -1, -1, dtype='uint64')
+    return ((values[...,np.newaxis] >> shifts) & np.uint64(1)).astype('uint8')
+
+def random_values(rng, shape, width, missing_fraction=0.05):
+    """Random integers of width bits, of which a fraction missing_fraction is missing (all bits 1).
+    """
+    values = rng.integers(0, 2**width-1, shape)
+    values[rng.random(shape) < missing_fraction] = 2**width-1
+    return values
+
+def header_bits():
+    #Block and station number, date (2017-07-31), time (01:00), latitude and longitude
+    fields = ((6, 7), (260, 10), (2017, 12), (7, 4), (31, 6), (1, 5), (0, 6), (5212345+9000000, 25), (1234567+18000000, 26))
+    return np.concatenate([to_bits(value, width) for value, width in fields])
+
+header_descr = ['301001', '301011', '301012', '005001', '006001']
+
+def radar_message(shape=(360, 600), delayed=True, seed=0):
+    """Message with reflectivity and radial velocity in len(shape) nested loops, where shape gives the number of iterations of each loop (from
+    outer to inner). With delayed=False fixed replication is used, which limits the number of iterations per loop to 255.
+    """
+    rng = np.random.default_rng(seed)
+    descr = ['021001', '021014']
+    n_instances = int(np.prod(shape))
+    #The data for the innermost iterations, for all instances at once
+    bits = np.concatenate([to_bits(random_values(rng, n_instances, 7), 7), to_bits(random_values(rng, n_instances, 13), 13)], axis=-1)
+    for level in reversed(range(len(shape))):
+        n = shape[level]
+        n_instances //= n
+        bits = bits.reshape((n_instances, -1))
+        if delayed:
+            count_descr, count_width = ('031001', 8) if n < 256 else ('031002', 16)
+            bits = np.concatenate([np.repeat(to_bits(n, count_width)[np.newaxis], n_instances, axis=0), bits], axis=1)
+            descr = ['1%02d000' % len(descr), count_descr]+descr
+        else:
+            if n > 255:
+                raise Exception('Fixed replication allows at most 255 iterations')
+            descr = ['1%02d%03d' % (len(descr), n)]+descr
+    return message(header_descr+descr, np.concatenate([header_bits(), bits.ravel()]))
+
+def outside_loops_message(n_descr=2000, seed=0):
+    """Message with n_descr temperatures that are not part of a loop, each given by its own descriptor in section 3.
+    """
+    rng = np.random.default_rng(seed)
+    bits = to_bits(random_values(rng, n_descr, 16), 16).ravel()
+    return message(header_descr+['012101']*n_descr, np.concatenate([header_bits(), bits]))
+
+def compressed_message(n_subsets=1000, n_it=10, seed=0):
+    """Compressed message with n_subsets subsets, that contain a header and a fixed loop of n_it iterations with reflectivity and radial velocity.
+    """
+    rng = np.random.default_rng(seed)
+    def compressed_bits(values, width):
+        #Reference value (the minimum), the number of bits of the increments, and the increments
+        valid = values != 2**width-1
+        vmin = values[valid].min()
+        increments = values-vmin
+        n_bits = int(increments[valid].max()+1).bit_length()
+        increments[~valid] = 2**n_bits-1
+        return np.concatenate([to_bits(vmin, width), to_bits(n_bits, 6), to_bits(increments, n_bits).ravel()])
+
+    bits = [compressed_bits(rng.integers(0, 100, n_subsets), 7), compressed_bits(rng.integers(0, 1000, n_subsets), 10)]
+    for value, width in ((2017, 12), (7, 4), (31, 6), (1, 5), (0, 6)):
+        bits.append(np.concatenate([to_bits(value, width), to_bits(0, 6)]))
+    bits += [compressed_bits(rng.integers(0, 10**7, n_subsets)+9000000, 25), compressed_bits(rng.integers(0, 10**7, n_subsets)+18000000, 26)]
+    for i in range(n_it):
+        bits += [compressed_bits(random_values(rng, n_subsets, 7), 7), compressed_bits(random_values(rng, n_subsets, 13), 13)]
+    return message(header_descr+['102%03d' % n_it, '021001', '021014'], np.concatenate(bits), n_subsets=n_subsets, compressed=True)
+
+def message(descr, data_bits, n_subsets=1, compressed=False):
+    """Returns an edition 4 message with the descriptors descr (strings FXXYYY) in section 3, and the bits data_bits (uint8 array with values 0
+    and 1) in section 4.
+    """
+    sec1 = bytes([0]) + center.to_bytes(2, 'big') + bytes([0, 0, 0, 0, 6, 3, 0, master_version, 0]) + (2017).to_bytes(2, 'big') + bytes([7, 31, 1, 0, 0])
+    sec1 = (len(sec1)+3).to_bytes(3, 'big') + sec1
+
+    fxy = np.array([(int(d[0]) << 14) | (int(d[1:3]) << 8) | int(d[3:]) for d in descr], dtype='>u2')
+    sec3 = bytes([0]) + n_subsets.to_bytes(2, 'big') + bytes([128 | (64 if compressed else 0)]) + fxy.tobytes()
+    sec3 = (len(sec3)+3).to_bytes(3, 'big') + sec3
+
+    data = np.packbits(data_bits).tobytes()
+    sec4 = bytes([0]) + data + bytes((len(data)+4) % 2)
+    sec4 = (len(sec4)+3).to_bytes(3, 'big') + sec4
+
+    content = sec1 + sec3 + sec4 + b'7777'
+    return b'BUFR' + (len(content)+8).to_bytes(3, 'big') + bytes([4]) + content
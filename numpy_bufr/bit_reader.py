@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Reading of bit fields directly from the packed bytes of a BUFR message.
+
+Earlier versions of the decoder expanded the complete (decompressed) content into an array of bits with np.unpackbits, which requires 8 times
+more memory than the content itself. The class BitReader below instead keeps the bytes packed, and extracts a field of a given width that starts at
+a given bit index by combining the bytes that contain the field, and shifting away the bits that belong to neighbouring fields.
+"""
+import numpy as np
+
+from . import bufr_functions as bf
+
+
+
+class BitReader():
+    def __init__(self, data, byte_start=0, byte_end=None):
+        """data can be a bytes object, a uint8 numpy array, or any other object that supports the buffer protocol (a memory map for example).
+        byte_start and byte_end can be used to restrict the reader to a part of data, e.g. to one section of a BUFR message. Bit indices that are
+        given to the methods of the reader are relative to byte_start. No copy of the data is made.
+        """
+        if not isinstance(data, np.ndarray):
+            data = bf.bytes_to_array(data)
+        byte_end = len(data) if byte_end is None else byte_end
+        self.bytes = data[byte_start:byte_end]
+        self.buffer = memoryview(self.bytes)
+        self.n_bits = 8*len(self.bytes)
+
+    def __len__(self):
+        #The length is given in number of bits, to be consistent with the bit indices that are used throughout the decoder
+        return self.n_bits
+
+    def section(self, byte_start, byte_end):
+        """Return a new reader for a part of the data, e.g. for one section of a BUFR message. byte_start and byte_end are relative to the start
+        of this reader.
+        """
+        return BitReader(self.bytes, byte_start, byte_end)
+
+    def read(self, n, width):
+        """Return the unsigned integer that is represented by the width bits starting at bit index n, assuming that the most significant bits are
+        placed first. Because a Python integer is returned, width is not limited to 64 bits.
+        """
+        n = int(n) #n can be a numpy integer, which would limit the shifts below to 64 bits
+        if n+width > self.n_bits:
+            raise IndexError('Reading beyond the end of the data (bits %d-%d of %d)' % (n, n+width, self.n_bits))
+        b_start, b_end = n >> 3, (n+width+7) >> 3
+        value = int.from_bytes(self.buffer[b_start:b_end], 'big')
+        return (value >> (8*b_end-n-width)) & ((1 << width)-1)
+
+    def read_signed(self, n, width):
+        """Like self.read, but the first bit represents the sign of the number (1 for negative numbers), and the remaining bits its magnitude.
+        This representation is used for e.g. reference values that are redefined with operator 203YYY.
+        """
+        value = self.read(n, width)
+        magnitude = value & ((1 << (width-1))-1)
+        return -magnitude if value >> (width-1) else magnitude
+
+    def read_bytes(self, n, n_bytes):
+        """Return the n_bytes bytes (8*n_bytes bits) starting at bit index n, which are used to represent strings (CCITT IA5). n does not need to be
+        a multiple of 8.
+        """
+        if n & 7 == 0:
+            if n+8*n_bytes > self.n_bits:
+                raise IndexError('Reading beyond the end of the data (bits %d-%d of %d)' % (n, n+8*n_bytes, self.n_bits))
+            return self.buffer[n >> 3:(n >> 3)+n_bytes].tobytes()
+        return self.read(n, 8*n_bytes).to_bytes(n_bytes, 'big')
+
+    def read_array(self, offsets, width):
+        """Vectorized version of self.read, that reads a field of width bits for each bit index in the array offsets. Returns an integer array with the
+        same shape as offsets, of type int64 (uint64 if width is 64).
+        The bytes that contain the fields are gathered with one array operation per byte, such that no bits need to be expanded.
+        """
+        offsets = np.asarray(offsets, dtype='int64')
+        if width > 57:
+            #At most 8 bytes can be combined into a 64-bit integer, which is sufficient for fields of at most 57 bits. Longer fields are
+            #read in two parts.
+            high = self.read_array(offsets, width-32).astype('uint64')
+            low = self.read_array(offsets+width-32, 32).astype('uint64')
+            values = (high << np.uint64(32)) | low
+            return values if width == 64 else values.astype('int64')
+        if offsets.size and (offsets.min() < 0 or offsets.max()+width > self.n_bits):
+            raise IndexError('Reading beyond the end of the data (%d bits)' % self.n_bits)
+        
+        n_bytes = (width+14) >> 3 #Number of bytes that can contain the field, given that it can start at any bit of the first byte
+        b_start = offsets >> 3
+        values = np.zeros(offsets.shape, dtype='uint64')
+        for k in range(n_bytes):
+            #mode='clip' prevents reading beyond the end of the data. Bytes that are clipped are never part of the field, and are shifted away below.
+            values = (values << np.uint64(8)) | self.bytes.take(b_start+k, mode='clip')
+        values >>= (8*n_bytes-width-(offsets & 7)).astype('uint64')
+        values &= np.uint64((1 << width)-1)
+        return values.astype('int64')
+    
+    def read_bytes_array(self, offsets, n_bytes):
+        """Vectorized version of self.read_bytes, that returns a uint8 array with shape offsets.shape+(n_bytes,).
+        """
+        offsets = np.asarray(offsets, dtype='int64')
+        if offsets.size and not np.any(offsets & 7):
+            #All fields start at an octet, such that the bytes can be taken directly
+            if offsets.min() < 0 or offsets.max()+8*n_bytes > self.n_bits:
+                raise IndexError('Reading beyond the end of the data (%d bits)' % self.n_bits)
+            return self.bytes[(offsets >> 3)[...,np.newaxis]+np.arange(n_bytes)]
+        return self.read_array(offsets[...,np.newaxis]+8*np.arange(n_bytes), 8).astype('uint8')
@@ -23,38 +23,80 @@ def bytes_to_array(data, datadepth = 8):
     return np.ndarray((int(len(data) / datawidth),),
                   dtype=datatype, buffer=data)
     
+_bit_weights = {} #Cached weight vectors (2**(width-1), ..., 2, 1) per width
+def get_bit_weights(width):
+    if not width in _bit_weights:
+        _bit_weights[width] = np.left_shift(1, np.arange(width-1, -1, -1, dtype='int64'))
+    return _bit_weights[width]
+
 def bits_to_n(bits,signed=False):
     """Convert a sequence of bits to a number, assuming that the most significant bits are placed first (big endian style)
     If signed=True, then it is assumed that the first bit represents the sign of the number, which is 1 when the first bit
-    is 0, and -1 otherwise.
+    is 0, and -1 otherwise (sign-magnitude representation).
+    For a numpy array the conversion takes place over the last dimension. The result is exact: it has type int64 for up to 63 bits, 
+    and for more bits it is an array of Python integers (object type).
     """
-    if type(bits)==np.ndarray:
-        if signed:
-            return -2*(bits[...,0]-0.5)*np.sum(bits[...,1:]*np.array([2**j for j in reversed(range(0,bits.shape[-1]-1))]),axis=-1)
-        else:
-            return np.sum(bits*np.array([2**j for j in reversed(range(0,bits.shape[-1]))]),axis=-1)      
+    if type(bits)!=np.ndarray:
+        return int(bits_to_n(np.asarray(bits, dtype='uint8'), signed))
+    
+    if signed:
+        magnitude = bits_to_n(bits[...,1:])
+        sign = 1-2*bits[...,0].astype('int64')
+        return sign*magnitude if bits.shape[-1] <= 64 else sign.astype(object)*magnitude
+    
+    width = bits.shape[-1]
+    if width > 63:
+        #Prevent overflow by converting the last 32 bits separately, and combining both parts as Python integers
+        high = np.asarray(bits_to_n(bits[...,:-32])).astype(object)
+        low = np.asarray(bits_to_n(bits[...,-32:])).astype(object)
+        return high*2**32+low
+    elif width > 16:
+        #For larger widths it is faster to first pack the bits into bytes (which pads zeros at the end), and combine these bytes
+        packed = np.packbits(bits, axis=-1)
+        n = packed[...,0].astype('uint64')
+        for k in range(1, packed.shape[-1]):
+            n = (n << 8) | packed[...,k]
+        return (n >> (8*packed.shape[-1]-width)).astype('int64')
+    elif width > 1:
+        return np.matmul(bits, get_bit_weights(width))
     else:
-        if signed:
-            return int(-2*(bits[0]-0.5)*np.sum(bits[1:]*np.array([2**j for j in reversed(range(0,len(bits)-1))])))
-        else:
-            return int(np.sum(bits*np.array([2**j for j in reversed(range(0,len(bits)))])))
+        return bits[...,0].astype('int64') if width == 1 else np.zeros(bits.shape[:-1], dtype='int64')
         
-def dtg(bits, edition=4):
+def split_fxy(descr):
+    """Returns arrays with F, X and Y for an array of descriptors, which are given as integers FXXYYY (e.g. 21014 for descriptor 021014).
+    """
+    descr = np.asarray(descr, dtype='int64')
+    return descr // 100000, descr // 1000 % 100, descr % 1000
+
+def descr_to_str(descr):
+    """Returns a list with the 6-character string form FXXYYY of each descriptor in descr (an array of integers FXXYYY).
+    """
+    return [format(d, '06') for d in np.asarray(descr).tolist()]
+
+def get_uint_dtype(width):
+    """Returns the smallest unsigned integer type that can hold values of width bits.
     """
+    for dtype in ('uint8', 'uint16', 'uint32'):
+        if width <= np.iinfo(dtype).bits:
+            return np.dtype(dtype)
+    return np.dtype('uint64')
+
+def dtg(reader, n=0, edition=4):
+    """Read the date and time that start at bit index n of the bit reader, with
     edition.3: year [yy], month, day, hour, minute
     edition.4: year [yyyy], month, day, hour, minute, second
     """
-    n = 8 if edition < 4 else 16
-    year = bits_to_n(bits[:n])
+    w = 8 if edition < 4 else 16
+    year = reader.read(n, w)
 
     if edition < 4: 
         if year>50: year += 1900
         else: year += 2000
         
-    month = bits_to_n(bits[n:n+8])
-    day = bits_to_n(bits[n+8:n+16])
-    hour = bits_to_n(bits[n+16:n+24])
-    minute = bits_to_n(bits[n+24:n+32])
-    second = bits_to_n(bits[n+32:n+40]) if edition==4 else 0
+    month = reader.read(n+w, 8)
+    day = reader.read(n+w+8, 8)
+    hour = reader.read(n+w+16, 8)
+    minute = reader.read(n+w+24, 8)
+    second = reader.read(n+w+32, 8) if edition==4 else 0
     
     return datetime.datetime(year, month, day, hour, minute, second)
\ No newline at end of file
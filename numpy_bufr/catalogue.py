@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent catalogue of the messages in an archive of BUFR files, stored in an SQLite database.
+
+For each message the catalogue contains the file, the byte offset and length of the message, the compression of the file, the metadata from
+sections 0, 1 and 3, and a hash of the template (see headers.py, from which the fields are taken). The catalogue is updated incrementally: Only files
+that are new or that have changed (in size or modification time) since the last update are scanned.
+
+Selecting messages (e.g. by time range, centre or template) is then done with an indexed query on the database, instead of rescanning the files.
+The selected messages can be decoded directly from their offsets with Catalogue.iter_decode, which passes the offsets to DecodeBUFR (using
+msg_offsets, and a memory map for uncompressed files).
+"""
+import glob
+import os
+import sqlite3
+import numpy as np
+
+from . import headers
+
+
+
+schema_version = 1 #Should be increased when the layout of the database changes, after which an existing database is rebuilt
+
+class Catalogue():
+    def __init__(self, db_path):
+        """db_path is the path of the SQLite database, which is created when it doesn't exist yet.
+        """
+        self.db_path = db_path
+        self.fields = [name for name, _ in headers.header_dtype]
+        self.connection = sqlite3.connect(db_path)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+            self.create_tables()
+
+    def create_tables(self):
+        #Column names are quoted, since 'update' is an SQL keyword
+        columns = ', '.join('"%s"' % name for name in self.fields)
+        with self.connection:
+            self.connection.execute('DROP TABLE IF EXISTS files')
+            self.connection.execute('DROP TABLE IF EXISTS messages')
+            self.connection.execute('CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)')
+            self.connection.execute('CREATE TABLE messages (path TEXT, %s)' % columns)
+            for name in ('path', 'datetime', 'center', 'template'):
+                self.connection.execute('CREATE INDEX messages_%s ON messages ("%s")' % (name, name))
+            self.connection.execute('PRAGMA user_version = %d' % schema_version)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        #The number of messages in the catalogue
+        return self.connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+
+
+    def update(self, file_paths, remove_missing=False):
+        """Add the messages in the files given by file_paths (a list of paths, or a glob pattern) to the catalogue. Files that are already present and
+        that have not changed since they were scanned are skipped. If remove_missing=True, then files in the catalogue that no longer exist are
+        removed from it.
+        Returns the number of files that has been scanned.
+        """
+        if isinstance(file_paths, str):
+            file_paths = sorted(glob.glob(file_paths))
+        known = dict((row[0], row[1:]) for row in self.connection.execute('SELECT path, size, mtime_ns FROM files'))
+
+        n_scanned = 0
+        insert = 'INSERT INTO messages VALUES (%s)' % ', '.join(['?']*(len(self.fields)+1))
+        for path in file_paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            rows = headers.scan_headers([path])
+            with self.connection:
+                self.connection.execute('DELETE FROM messages WHERE path = ?', (path,))
+                self.connection.executemany(insert, (self.to_sql(row) for row in rows))
+                self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns))
+            n_scanned += 1
+
+        if remove_missing:
+            with self.connection:
+                for path in known:
+                    if not os.path.exists(path):
+                        self.connection.execute('DELETE FROM messages WHERE path = ?', (path,))
+                        self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+        return n_scanned
+
+    def to_sql(self, row):
+        """Convert a row of the record array returned by headers.scan_headers to values that can be stored in the database. The datetime is stored in
+        seconds since 1970-01-01, and the template hash as a signed 64-bit integer (since SQLite doesn't support unsigned integers).
+        """
+        values = list(row.item())
+        i_datetime, i_template = 1+self.fields.index('datetime'), 1+self.fields.index('template')
+        values[i_datetime] = int(row['datetime'].astype('int64'))
+        values[i_template] = int(np.uint64(row['template']).astype('int64'))
+        return values
+
+
+
+    def select(self, start=None, end=None, center=None, template=None, **fields):
+        """Returns a record array with the messages that have a datetime in the range [start, end), and the given center and template hash.
+        start and end can be anything that can be converted to numpy.datetime64 (e.g. a datetime object, or a string like '2017-07-31T12:00').
+        Other fields (e.g. cat) can be given as keyword arguments. Arguments that are None are not used for the selection.
+        The fields of the record array are the same as those returned by headers.scan_headers, and the messages are sorted by datetime, path and
+        offset.
+        """
+        conditions, values = [], []
+        if not start is None:
+            conditions.append('"datetime" >= ?'); values.append(int(np.datetime64(start, 's').astype('int64')))
+        if not end is None:
+            conditions.append('"datetime" < ?'); values.append(int(np.datetime64(end, 's').astype('int64')))
+        if not template is None:
+            conditions.append('"template" = ?'); values.append(int(np.uint64(template).astype('int64')))
+        fields['center'] = center
+        for name in fields:
+            if not fields[name] is None:
+                if not name in self.fields and name != 'path':
+                    raise Exception('Unknown field '+name)
+                conditions.append('"%s" = ?' % name); values.append(fields[name])
+
+        query = 'SELECT * FROM messages'
+        if conditions:
+            query += ' WHERE '+' AND '.join(conditions)
+        rows = self.connection.execute(query+' ORDER BY "datetime", path, "offset"', values).fetchall()
+
+        path_width = max([len(row[0]) for row in rows]+[1])
+        dtype = np.dtype([('path', 'U%d' % path_width)]+headers.header_dtype)
+        messages = np.zeros(len(rows), dtype=dtype).view(np.recarray)
+        if rows:
+            columns = list(zip(*rows))
+            for j, name in enumerate(dtype.names):
+                if name == 'datetime':
+                    messages[name] = np.array(columns[j], dtype='int64').astype('datetime64[s]')
+                elif name == 'template':
+                    messages[name] = np.array(columns[j], dtype='int64').view('uint64')
+                else:
+                    messages[name] = columns[j]
+        return messages
+
+    def iter_decode(self, decoder, messages, **options):
+        """Decodes the messages that are given by the record array messages (as returned by self.select) with decoder (an instance of DecodeBUFR),
+        and yields (message, result) for each of them, where result is the tuple (metadata, full_description, data, data_loops) for the message.
+        The messages in a file are decoded together, directly from their offsets. Uncompressed files are memory-mapped, such that only the pages that
+        contain the selected messages are read from disk. options are passed to decoder.iter_messages (e.g. read_mode).
+        The messages are yielded grouped per file, in the order in which the files first occur in messages, and sorted by offset within a file. Each
+        result is matched to its message by the offset at which the decoder found it (decoder.message_offset), and an exception is raised when a
+        message is not found (e.g. because the file has changed since the catalogue was updated). The messages are therefore decoded in this process,
+        and n_processes > 1 is not supported.
+        """
+        if options.get('n_processes', 1) > 1:
+            raise Exception('iter_decode does not support n_processes > 1')
+        paths = list(dict.fromkeys(messages['path'].tolist()))
+        for path in paths:
+            selected = messages[messages['path'] == path]
+            by_offset = {int(message['offset']): message for message in selected}
+            offsets = sorted(by_offset)
+            for result in decoder.iter_messages(path, use_mmap=True, msg_offsets=offsets, **options):
+                yield by_offset[decoder.message_offset], result
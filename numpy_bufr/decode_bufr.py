@@ -4,12 +4,15 @@ Created on Sat Feb 10 12:04:20 2018
 
 @author: bramv
 """
-import re
-import gzip
-import bz2
+import io
+import mmap
 import numpy as np
 
 from . import decode_metadata
+from . import decode_plan
+from . import stream
+from . import parallel
+from .bit_reader import BitReader
 from .tables import load_tables
 from .tables.tables import get_descr_full
 from . import bufr_functions as bf
@@ -18,91 +21,223 @@ from . import bufr_functions as bf
 
 """This is a very efficient numpy-based decoder for BUFR files. It is aimed at decoding volumetric radar data provided by the DWD, but it should be 
 sufficiently general to handle much more formats. It works at least for edition 3, but is also expected to work with edition 4.
-Two things that are at least not yet supported, are BUFR files with multiple subsets in section 4, and a section 2 in the BUFR file. If a section 2
-is present, then it is simply skipped (but the decoding of the other sections should still succeed).
+One thing that is at least not yet supported, is a section 2 in the BUFR file. If a section 2 is present, then it is simply skipped (but the decoding
+of the other sections should still succeed). Multiple subsets in section 4 are supported, and the data for each descriptor is then returned as an array
+over subsets.
 Further, only a few operators are supported yet, but it shouldn't be that difficult to include support for more operators.
-Also, compression within the BUFR file is not handled yet.
+Compressed data (indicated by a flag in section 3) is decoded for all subsets at once, see the function DecodeBUFR.decode_section4_compressed.
 
-Decoding of the BUFR starts by converting the content to a 1D array of bits (uint8 type, implying that 8 times more memory is used than originally).
-Next, the meta data is obtained, which includes a list of the descriptors that are present in section 4. 
+The content of the BUFR is not expanded into an array of bits. Instead, a bit reader (see bit_reader.py) extracts each field directly from the packed
+bytes, using the bit index at which the field starts and its width.
+Decoding of the BUFR starts by obtaining the meta data, which includes a list of the descriptors that are present in section 4. 
 When decoding section 4, which contains the data, one important reason for the efficiency of the decoder is the way in which loops (indicated by replication
 operators) are treated: 
     First, the size of the data that is contained in the loop in determined, which is the number of bits contained in the loop.
-Next the data for each loop (and possible nested loops) is put in a different array, which is reshaped in such a way that the last dimension includes the
-descriptors for one iteration of the loop. This allows efficient slicing of the data when actually decoding it, which is the final step.
+Next the bit index at which each iteration of the loop (and of possible nested loops) starts is determined, which gives an array with one dimension
+per nesting level. Adding to this array the position of a descriptor within one iteration gives the bit indices of all values of that descriptor, which
+are then gathered from the packed bytes at once by the bit reader. This is the final step, in which the data is actually decoded.
 
-A drawback of this method is that it is not very memory efficient, among others because the BUFR is converted to an array of bits (as mentioned above), but
-also because the data for each nested loop is stored in a different array (see the function get_bits_in_loops). If memory usage becomes important, then the first
-step to reduce memory usage should likely be finding a more efficient way to store data for different nested loops.
-
-A DWD-specific piece of code decompresses bz2-compressed data. If other types of compression are carried out, then the appropriate decompression must be included.
+Files that are compressed with bz2 (as is the case for DWD radar data), gzip or xz are not decompressed as a whole. Instead they are decompressed
+in chunks, and each message is decoded as soon as it has been extracted from the decompressed stream (see stream.py). Other types of compression 
+require adding the appropriate decompressor there.
 
 
 Part of the code is based on/ copied from the package trollbufr, created by Alex Maul: https://github.com/alexmaul/trollbufr
 That's completely the case for the script load_tables, and for a large part for the script decode_metadata.
 """
 class DecodeBUFR():
-    def __init__(self, table_path, table_type = 'eccodes'): 
+    def __init__(self, table_path, table_type = 'eccodes', result_cache=None): 
         """table_type must be one of 'eccodes' and 'libdwd'.
         table_path is the path to the tables.
+        result_cache can be an instance of result_cache.ResultCache, in which case the results for messages that have been decoded before (with the
+        same tables and options) are taken from this cache. Arrays in cached results are memory-mapped and read-only.
         """
         self.table_path = table_path
         self.table_type = table_type
+        self.result_cache = result_cache
         
+        self.message_offset = None #Byte offset of the message that is being decoded, in the (decompressed) content of the file
         self.tables = None
     
     
     
-    def __call__(self, file_path_or_bytes, table_path = None, table_type = None, read_mode='all'):
+    def __call__(self, file_path_or_bytes, table_path = None, table_type = None, read_mode='all', use_mmap=False, msg_offsets=None, n_processes=1,
+                 dtype='float64', missing='nan', strings='str'):
         """Returns the meta data contained in the BUFR, a full description of the data descriptors, the decoded data, and the decoded data for descriptors 
         that are included inside loops.
         The read_mode specifies which part of the BUFR is decoded. It can be one 'all','outside_loops', or a list with descriptors. 
         read_mode='all' means that the whole file is decoded, and read_mode='outside_loops' means that only the part of the data that is 
         located outside loops is decoded. This can be useful when only some information about the data is needed, and not the data itself.
         If you provide a list of descriptors for read_mode, then inside loops only data for these descriptors will be decoded. 
+        
+        If use_mmap=True, then an uncompressed file is memory-mapped instead of read, such that only the pages of the file that are actually needed
+        for decoding are read from disk. This is useful in combination with msg_offsets, which can be used to specify a list with the byte offsets of 
+        the messages that should be decoded (by default all messages in the file are decoded). For compressed files these are offsets in the 
+        decompressed content, and use_mmap has no effect.
+        
+        dtype determines the type of the arrays with decoded data. It can be 'float64' (the default), 'float32', or 'raw'. With dtype='raw' the 
+        packed integers are returned without applying the refval and scale, in the smallest unsigned integer type that can hold them (e.g. uint8 for
+        8-bit radar data), and missing values keep all bits set to 1. Values outside loops (for a single subset) are numpy scalars of the same type as
+        the arrays, also for dtype='float32' and 'raw'. The scale and refval are given as a tuple (scale, refval), such that physical values are
+        obtained as (raw+refval)*10**-scale. Since they can differ between occurrences of a descriptor (due to operators), metadata['scaling'] mirrors
+        the structure of the data: metadata['scaling']['data'][d] is a list with the tuple for each value in data[d] (None for strings), and
+        metadata['scaling']['data_loops'][i][d] gives the tuple for data_loops[i][d].
+        
+        Values for which all bits are 1 are missing. In arrays with decoded data (including data in loops) they are set to NaN if missing='nan' 
+        (for dtype='raw' they keep all bits set to 1), and if missing='mask' then a masked array (np.ma.MaskedArray) is returned in which they are 
+        masked. The missing values are determined from the packed integers, while converting them to the output type. Missing values outside
+        loops (for a single subset) are None.
+        
+        Arrays with strings (CCITT IA5), including those in loops, are decoded at once from the packed bytes into a fixed-width numpy.bytes_ array.
+        With strings='str' (the default) this array is converted to str, and with strings='bytes' it is returned as is, such that it can be 
+        converted later when needed (e.g. with np.char.decode). Missing strings are empty.
+        
+        If n_processes > 1, then the messages are decoded in parallel by a pool of n_processes worker processes (see parallel.py). The results are
+        still returned in the order of the messages. The pool is kept alive for later calls with the same n_processes and tables (see
+        parallel.get_pool), such that the workers don't need to be started again. The result cache (see self.__init__) is then not used.
+        
+        All messages are decoded before returning. Use self.iter_messages to obtain the results one message at a time.
+        """
+        metadata, full_description, data, data_loops = [], [], [], []
+        for result in self.iter_messages(file_path_or_bytes, table_path, table_type, read_mode, use_mmap, msg_offsets, n_processes, dtype, missing, strings):
+            metadata.append(result[0])
+            full_description.append(result[1])
+            data.append(result[2])
+            data_loops.append(result[3])
+        return metadata, full_description, data, data_loops
+    
+    def iter_messages(self, file_path_or_bytes, table_path = None, table_type = None, read_mode='all', use_mmap=False, msg_offsets=None, n_processes=1,
+                      dtype='float64', missing='nan', strings='str'):
+        """Generator version of self.__call__, that yields (metadata, full_description, data, data_loops) for each message as soon as it has been 
+        decoded. The results for a message can then be processed (and discarded) before the next message is decoded, such that memory usage
+        doesn't grow with the number of messages in the file. The arguments are the same as for self.__call__.
         """
         #If you want to overwrite the default table path and type, specified during the initialization of the class, then table_path and table_type
         #should differ from None.
         if not table_path is None: self.table_path = table_path
         if not table_type is None: self.table_type = table_type
         self.read_mode = read_mode
-              
-        if type(file_path_or_bytes) == bytes:
-            self.content = file_path_or_bytes
-        else:
-            with open(file_path_or_bytes, 'rb') as f:
-                self.content = f.read()
-        magic = self.content[:2]
-        if magic == b'BZ':
-            self.content = bz2.decompress(self.content)
-        elif magic == b'\x1f\x8b':
-            self.content = gzip.decompress(self.content)
-    
-        uints = bf.bytes_to_array(self.content)
-        self.data_bits=np.unpackbits(uints)
-        
-        bufr_indices = self.get_messages_in_BUFR_file()
+        if not dtype in ('float64', 'float32', 'raw'):
+            raise Exception("dtype should be one of 'float64', 'float32' and 'raw'")
+        self.dtype = dtype
+        if not missing in ('nan', 'mask'):
+            raise Exception("missing should be one of 'nan' and 'mask'")
+        self.missing = missing
+        if not strings in ('str', 'bytes'):
+            raise Exception("strings should be one of 'str' and 'bytes'")
+        self.strings = strings
         
-        metadata, full_description, data, data_loops = [], [], [], []
-        for i in bufr_indices:
+        if n_processes > 1:
+            messages = self.iter_message_bytes(file_path_or_bytes, use_mmap, msg_offsets)
+            yield from parallel.decode_messages(messages, n_processes, self.table_path, self.table_type, read_mode=read_mode, dtype=dtype,
+                                               missing=missing, strings=strings)
+            return
+              
+        for self.reader, i in self.get_message_readers(file_path_or_bytes, use_mmap, msg_offsets):
             self.get_metadata_and_divide_BUFR_message_into_sections(i)
             
+            if not self.result_cache is None:
+                #The key can be determined without loading the tables
+                table_key = load_tables.get_table_key(self.metadata, self.table_path, self.table_type)
+                message = self.reader.bytes[i:i+self.metadata['size']]
+                key = self.result_cache.get_key(message, table_key, read_mode, dtype=dtype, missing=missing, strings=strings)
+                result = self.result_cache.get(key)
+                if not result is None:
+                    yield result
+                    continue
+            
             self.load_tables()
-            self.replace_sequence_descriptors()
+            self.get_decode_plan()
             
-            self.get_full_description()
             self.decode_section4()
             
-            metadata.append(self.metadata)
-            full_description.append(self.full_description)
-            data.append(self.data)
-            data_loops.append(self.data_loops)
-        return metadata, full_description, data, data_loops
+            if not self.result_cache is None:
+                self.result_cache.add(key, (self.metadata, self.full_description, self.data, self.data_loops))
+            yield self.metadata, self.full_description, self.data, self.data_loops
+    
+    
+    
+    def get_message_readers(self, file_path_or_bytes, use_mmap=False, msg_offsets=None):
+        """Yields for each message that should be decoded a bit reader, and the byte index at which the message starts for that reader.
+        Compressed content is decompressed in chunks, and each message is yielded as soon as it is complete (see stream.iter_messages), with a
+        reader that contains only that message. Only one message is then kept in memory. Uncompressed content is read (or memory-mapped) as a
+        whole, and one reader is used for all messages. A memory map is closed when the generator is finished, also when the caller stops early or
+        decoding raises an exception.
+        The offset of the current message in the (decompressed) content is stored in self.message_offset. An exception is raised when no message
+        starts at one of msg_offsets.
+        """
+        f = io.BytesIO(file_path_or_bytes) if type(file_path_or_bytes) == bytes else open(file_path_or_bytes, 'rb')
+        with f:
+            codec = stream.detect_codec(f.read(8))
+            if not codec is None:
+                f.seek(0)
+                remaining = None if msg_offsets is None else set(int(offset) for offset in msg_offsets)
+                for offset, message in stream.iter_messages(f):
+                    if remaining is None or offset in remaining:
+                        self.content = message
+                        self.message_offset = offset
+                        yield BitReader(message), 0
+                        if not remaining is None:
+                            remaining.discard(offset)
+                            if not remaining:
+                                #The rest of the content doesn't need to be decompressed
+                                return
+                if remaining:
+                    raise Exception('No message found at offsets '+', '.join(map(str, sorted(remaining))))
+                return
+        
+        self.read_content(file_path_or_bytes, use_mmap)
+        try:
+            reader = BitReader(self.content)
+            bufr_indices = self.get_messages_in_BUFR_file() if msg_offsets is None else msg_offsets
+            for i in bufr_indices:
+                if not msg_offsets is None and self.content[i:i+4] != b'BUFR':
+                    raise Exception('No message found at offset '+str(i))
+                self.message_offset = int(i)
+                yield reader, i
+        finally:
+            reader = None
+            self.close_content()
+    
+    def iter_message_bytes(self, file_path_or_bytes, use_mmap=False, msg_offsets=None):
+        """Yields the bytes of each message that should be decoded, using the total length of the message that is given in section 0.
+        """
+        for reader, i in self.get_message_readers(file_path_or_bytes, use_mmap, msg_offsets):
+            length = reader.read(8*i+32, 24)
+            yield reader.bytes[i:i+length].tobytes()
+    
+    def read_content(self, file_path_or_bytes, use_mmap=False):
+        """Read uncompressed content. Compressed content is handled by self.get_message_readers.
+        """
+        if type(file_path_or_bytes) == bytes:
+            self.content = file_path_or_bytes
+        else:
+            with open(file_path_or_bytes, 'rb') as f:
+                if use_mmap:
+                    #The mapping remains valid after closing the file
+                    self.content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self.content = f.read()
+            
+    def close_content(self):
+        """Close a possible memory map. The decoded data does not refer to the content, but the bit readers do, and they are therefore removed first.
+        """
+        if isinstance(self.content, mmap.mmap):
+            self.reader = None; self.secs = {}
+            try:
+                self.content.close()
+            except BufferError:
+                #Views of the content still exist, in which case the map is closed when it is garbage collected
+                pass
         
         
         
     def get_messages_in_BUFR_file(self):
-        return [i.start() for i in re.finditer(b'BUFR', self.content)]
+        """Returns the byte offsets of the messages in self.content. The complete index of the messages, with the offset, length and edition of each
+        message, is stored in self.message_index (see stream.scan_messages).
+        """
+        self.message_index = stream.scan_messages(self.content)
+        return self.message_index['offset']
         
     def get_metadata_and_divide_BUFR_message_into_sections(self, msg_start_index):
         """Divide the BUFR into sections
@@ -118,8 +253,8 @@ class DecodeBUFR():
                 continue #Section 2 is not present in this case
             
             if not j in self.sec_lengths:
-                self.sec_lengths[j] = bf.bits_to_n(self.data_bits[n:n+24])*8 #Section lengths are always given in 24 bits
-            self.secs[j] = self.data_bits[n:n+self.sec_lengths[j]]
+                self.sec_lengths[j] = self.reader.read(n, 24)*8 #Section lengths are always given in 24 bits
+            self.secs[j] = self.reader.section(n//8, (n+self.sec_lengths[j])//8) #Bit reader for the section, sections always start at an octet
             
             n += self.sec_lengths[j]
             
@@ -136,21 +271,31 @@ class DecodeBUFR():
         """Load the tables that are required to interpret the self.data descriptors, and to decode the self.data in section 4
         """
         self.tables = load_tables.get_tables(self.metadata, self.table_path, self.table_type)
+        self.table_key = load_tables.get_table_key(self.metadata, self.table_path, self.table_type)
+        
+    def get_decode_plan(self):
+        """Get the decode plan for the descriptors in section 3, which is compiled when it is not yet present in the cache decode_plan.plans.
+        Replacing the sequence descriptors and obtaining the full description is also only done when compiling the plan.
+        """
+        key = (tuple(self.metadata['descr'].tolist()), self.table_key)
+        self.plan = decode_plan.plans.get(key)
+        if self.plan is None:
+            self.replace_sequence_descriptors()
+            self.get_full_description()
+            self.plan = decode_plan.compile_plan(self.metadata['descr'], self.tables, self.full_description, self.descr_source)
+            decode_plan.plans.add(key, self.plan)
+        
+        #For the decoded results the descriptors are given as strings
+        self.metadata['descr'] = list(self.plan.descr)
+        self.full_description = list(self.plan.full_description)
 
     def replace_sequence_descriptors(self):
         """Replace sequence descriptors (those for which the first digit (F) is 3) by the sequence of descriptors that they represent, which are 
-        given in table D
+        given in table D.
+        The expanded sequences are cached per set of tables (see Tables.expand_sequence), and self.descr_source gives for each expanded descriptor
+        the sequence descriptor from which it originates (-1 for descriptors that are given directly in section 3).
         """
-        while any([i.startswith('3') for i in self.metadata['descr']]):
-            new_descr = []
-            for i in self.metadata['descr']:
-                if i[0]=='3':
-                    descr_sequence = self.tables.tab_d[int(i)]
-                    for j in descr_sequence:
-                        new_descr.append(format(j, '06'))
-                else:
-                    new_descr.append(i)
-            self.metadata['descr'] = new_descr.copy()
+        self.metadata['descr'], self.descr_source = self.tables.expand_descriptors(self.metadata['descr'])
 
         
                 
@@ -159,30 +304,32 @@ class DecodeBUFR():
         self.metadata['descr']. These descriptors consists of 6 digits, and have the FXY format. Here, F is given by the first digit, and represents the
         type of descriptor. X is given by the next 2 digits, and represent the class of the descriptor. Y is given by the final 3 digits, and represents the
         number of the descriptor within that class.
+        The descriptors have been compiled into a decode plan (see decode_plan.py), which contains the width, scale and refval for each element, and the
+        structure of the loops. Decoding section 4 consists of executing this plan, during which only the delayed replication factors need to be read.
         
         If F==1, then the descriptor is a replication operator, implying that a loop is present. The way in which loops are handled is important for the 
         efficiency of the decoder, and finding a good method is not so easy, especially since nested loops can be present.
-        Here loops are handled by first determining info over the number of iterations, size of the loop, and some other parameters, whereafter the data
-        in each loop is isolated from the rest. This data is reshaped in such a way (function self.get_bits_in_loops) that the last dimension contains the 
-        data for one iteration of the loop. This allows efficient slicing when decoding the data in the loop.
-        Nested loops are handled by assigning to each (nested) loop a different loop ID, and repeating a similar treatment for all nested loops.
-        ID=0 refers to the 1D array with all bits from section 4.
+        Here loops are handled by first determining the number of iterations and the number of bits per iteration, whereafter the bit indices at which the
+        iterations of the loop start are calculated (function self.decode_loop). This gives an array in which each dimension represents one nesting
+        level, which allows decoding all values of a descriptor in the loop at once.
+        
+        Section 4 can contain more than one subset, i.e. more than one repetition of the data described by self.metadata['descr'], see the function
+        self.decode_multiple_subsets. The handling of compressed data is described in the function self.decode_section4_compressed.
         """
-        self.bits = {0:self.secs[4]} #Contains all bits from section 4 that are included in the loop, reshaped into a (i+1)-dimensional array.
-        self.start_descr = {0:0} #Contains the start index of the first descriptor in the loop, i.e. the index of that descriptor in self.metadata['descr']
-        self.start_n = {0:0} #Contains for each loop the bit index at which it starts, where the value for loop i refers to the last dimension in 
-        #self.bits[i-1].
-        self.n_descr = {0:len(self.metadata['descr'])} #Number of descriptors included in the loop, excluding a possible delayed replication descriptor that
-        #describes the number of descriptors immediately after the loop operator.
-        self.loopdescr_widths = {} #Data width (in bits) of the delayed replication descriptors that give the number of loop iterations. Is zero if not present.
-        self.d_indices = {0:0} #Descriptor indices for the list self.metadata['descr']
-        self.n_it = {0:1} #Number of iterations per loop
-        self.n_bits = {0:len(self.secs[4])} #Number of bits in a loop, excluding bits used for a possible delayed replication descriptor.
-        self.loop_parameters = [self.bits, self.start_descr, self.start_n, self.n_descr, self.loopdescr_widths, self.d_indices, self.n_it, self.n_bits]
+        self.n_subsets = self.metadata['subsets']
+        self.n = 32 #Bit index for the 1D array self.secs[4]. The first 4 octets in self.secs[4] are not used to represent data
         
+        if self.metadata['comp']:
+            self.reset_decoding_state()
+            self.decode_section4_compressed()
+        elif self.n_subsets > 1:
+            self.decode_multiple_subsets()
+        else:
+            self.decode_subsets(np.zeros((), dtype='int64'))
+            
+    def reset_decoding_state(self):
         self.base_loop_i = 1 #A base loop is defined as a complete series of nested loops, from the outer most one to the inner most one. For each base loop,
         #the data for the descriptors that are present in the loop is stored in the dictionary self.data_loops[self.base_loop_i].
-        self.n = 32 #Bit index for the 1D array self.secs[4]. The first 4 octets in self.secs[4] are not used to represent data
         
         self.data = {} #Contains data for descriptors that are not placed in loops. The data for each descriptor is put in a list, because a descriptor might
         #be listed more than once in self.metadata['descr']
@@ -190,196 +337,344 @@ class DecodeBUFR():
         #it was found that some descriptors appear both inside and outside a loop, where the value outside the loop might be an average of values
         #inside the loop.
         
-        self.redefining_refval = False; self.redefining_refval_width = 0
-        self.widths = {}; self.scales = {}; self.refvals = {}
-        self.add_width = 0; self.add_scale = 0
-        while True:
-            d = self.metadata['descr'][self.d_indices[0]]; d_int = int(d)
-                         
-            if d[0]=='0':
-                if not d in self.data: self.data[d] = []
-                
-                self.decode_element_descriptor(d, d_int)
-                self.d_indices[0] += 1
-                
-            elif d[0]=='1': 
-                """First get information about the loop, including its size, before decoding the data.
-                """
-                self.get_loop_info(1, d, d_int)
-                if self.read_mode!='outside_loops':
-                    self.get_bits_in_loops() #Obtain the (i+1)-dimensional array that contains all data present in the loop, where i refers to the loop index.
-                    self.decode_data_in_loops()
-                
-                self.d_indices[0] += self.n_descr[1] + 1 + (1 if self.loopdescr_widths[1]>0 else 0)
-                self.n = self.start_n[1]+self.n_bits[1]
-                
-                for i in self.loop_parameters:
-                    #Remove all keys in the dictionaries that refer to values for the loops. This is necessary when there exists more
-                    #than one loop (i.e. more than one 'base' loop, excluding nested loops), to prevent that values for the previous 
-                    #loop(s) are used.
-                    for j in list(i.keys()):
-                        if j>0:
-                            del i[j]
-                            
+        self.refvals = {} #Reference values that are redefined with operator 203YYY
+        
+        self.data_nodes = {} #Contains for each descriptor in self.data a list with the node (from the decode plan) for each value
+        if self.dtype=='raw':
+            self.metadata['scaling'] = {'data':{}, 'data_loops':{}} #Contains (scale, refval) for each value, see self.add_scaling
+            
+    def decode_subsets(self, subset_offsets, decode_data=True):
+        """Decode the data for the nodes in the decode plan, starting at bit index self.n. subset_offsets is a 0-dimensional array when a single subset 
+        is decoded. When multiple subsets with the same layout are decoded at once, then it is a 1D array with for each subset the number of bits between
+        the start of that subset and the start of the first subset. In the latter case, the data for each descriptor has an additional first dimension,
+        which represents the subsets.
+        If decode_data=False, then only self.n is increased, without decoding data.
+        """
+        self.reset_decoding_state()
+        for node in self.plan.nodes:
+            if isinstance(node, decode_plan.Loop):
+                self.n = self.decode_loop(node, subset_offsets, self.n, decode_data and self.read_mode!='outside_loops')
                 self.base_loop_i += 1
                 self.data_loops[self.base_loop_i] = {}
-                                    
-            elif d[0]=='2':
-                self.evaluate_operator(d) 
-                self.d_indices[0] += 1
-                
-            if self.d_indices[0]==self.n_descr[0]:
-                break
-                
-                                        
+            else:
+                self.decode_element_descriptor(node, subset_offsets, decode_data)
     
-    def decode_element_descriptor(self, d, d_int, decode_data=True):
-        if not self.redefining_refval:
-            #In this case the descriptor represents an element
-            typ = self.tables.tab_b[d_int].typ
-            self.widths[d] = self.tables.tab_b[d_int].width + self.add_width
-            self.scales[d] = self.tables.tab_b[d_int].scale + self.add_scale
-            if not d in self.refvals:
-                #Prevent that a redefined reference value gets overwritten
-                self.refvals[d] = self.tables.tab_b[d_int].refval
-            
-            if decode_data:
-                bits = self.secs[4][self.n:self.n+self.widths[d]]
-                if np.all(bits==1):
-                    #This usually indicates that the value is missing
-                    self.data[d].append(None)
-                else:     
-                    if typ=='string':
-                        str_bytes = np.packbits(bits)
-                        self.data[d].append(str(str_bytes[str_bytes>0],'utf-8'))
-                    else:
-                        self.data[d].append((bf.bits_to_n(bits)+self.refvals[d])/10**self.scales[d])
-                    
-            self.n += self.widths[d]
-        else:
+    def decode_element_descriptor(self, node, subset_offsets, decode_data=True):
+        d = node.descr
+        if isinstance(node, decode_plan.RefvalRedefinition):
             #Redefine the reference value
-            self.refvals[d] = bf.bits_to_n(self.secs[4][self.n:self.n+self.redefining_refval_width],signed=True)
-                
-            self.n += self.redefining_refval_width
-            
-            
-    def evaluate_operator(self, d):
-        """In this case the descriptor represents an operator. 
-        See the file operator.TABLE in the table directory for their interpretation.
-        """
-        if d[1:3]=='01':
-            #Change self.add_width
-            self.add_width = 0 if d[3:]=='000' else int(d[3:])-128
-        elif d[1:3]=='02':
-            #Change self.add_scale
-            self.add_scale = 0 if d[3:]=='000' else int(d[3:])-128
-        elif d[1:3]=='03':
-            if d[3:]!='255':
-                self.redefining_refval = True                
-                self.redefining_refval_width = int(d[3:])
+            self.refvals[d] = self.secs[4].read_signed(subset_offsets.flat[0]+self.n, node.width)
+            self.n += node.width
+            return
+        
+        #In this case the descriptor represents an element
+        if not d in self.data: self.data[d] = []
+        if decode_data:
+            self.add_scaling(node)
+        if decode_data and subset_offsets.ndim > 0:
+            self.data[d].append(self.decode_subset_values(subset_offsets+self.n, node))
+        elif decode_data:
+            value = self.secs[4].read(self.n, node.width)
+            if value==(1 << node.width)-1 and not (self.dtype=='raw' and node.typ!='string'):
+                #All bits are 1, which usually indicates that the value is missing
+                self.data[d].append(None)
+            elif node.typ=='string':
+                str_bytes = value.to_bytes(node.width//8, 'big')
+                self.data[d].append(str(str_bytes.replace(b'\x00', b''),'utf-8'))
             else:
-                self.redefining_refval = False
-                
-                
-    def get_loop_info(self, i, d, d_int):
-        """In the loop operator (FXY), X gives the number of descriptors that is included in the loop, 
-        i.e. '110000' means that 10 descriptors are included. Y gives the the number of iterations in the loop, 
-        and is zero when this number is set by a delayed descriptor of the format '031YYY'.
-       
-        This function determines the number of descriptors involved in the loop, the number of iterations, the total number
-        of bits involved in the loop, and a few other required parameters. These include the index of the first descriptor in the loop
-        for the list self.metadata['list'], the number of bits used for a possible delayed replication descriptor, and self.start_n,
-        which gives for a loop i the index of the first bit contained in the loop, relative to the last dimension of self.bits[i-1].
-
-        Further, also the width, scale and refval of the descriptor are determined in this process, such that this does not need to
-        be done anymore in the function self.decode_data_in_loops.
-        
-        A loop can contain nested loops, and if such a nested loop is encountered, then this function is simply called again from within this function,
-        with i increased by 1.
-        """        
-        
-        self.n_descr[i] = int(d[1:3])
-        self.start_descr[i] = self.d_indices[i-1]+1 if d[3:]!='000' else self.d_indices[i-1]+2
-        #A possible delayed replication descriptor is not included in the number of descriptors inside the loop
-        
-        if d[3:]=='000':
-            #Get the number of iterations from the delayed descriptor
-            delayed_descr = self.metadata['descr'][self.d_indices[i-1]+1]
-            self.loopdescr_widths[i] = self.tables.tab_b[int(delayed_descr)].width
-            self.n_it[i] = bf.bits_to_n(self.secs[4][self.n:self.n+self.loopdescr_widths[i]])
+                self.data[d].append(self.scale_values(value, node))
+        self.n += node.width
+    
+    def add_scaling(self, node, base_loop_i=None):
+        """Register the node that gives the value that is added to self.data (or to self.data_loops[base_loop_i]), and for raw output store its
+        (scale, refval) at the same position in self.metadata['scaling'] (None for strings). A descriptor can occur multiple times with a different 
+        scale or refval, due to operators 202YYY and 203YYY.
+        """
+        if base_loop_i is None:
+            self.data_nodes.setdefault(node.descr, []).append(node)
+        if self.dtype!='raw':
+            return
+        scaling = None if node.typ=='string' else (node.scale, self.refvals.get(node.descr, node.refval))
+        if base_loop_i is None:
+            self.metadata['scaling']['data'].setdefault(node.descr, []).append(scaling)
         else:
-            self.n_it[i] = int(d[3:])
-            self.loopdescr_widths[i] = 0
-        self.n += self.loopdescr_widths[i]
+            self.metadata['scaling']['data_loops'].setdefault(base_loop_i, {})[node.descr] = scaling
         
-        self.start_n[i] = self.n if i==1 else self.n-np.sum([self.start_n[j] for j in self.start_n if j<i])
+    def decode_subset_values(self, offsets, node):
+        """Decode the values of an element for multiple subsets at once, starting at the bit indices in offsets. Missing values are treated as 
+        described in self.scale_values (missing strings become empty strings).
+        """
+        if node.typ=='string':
+            return self.string_values(self.secs[4].read_bytes_array(offsets, node.width//8))
+        return self.scale_values(self.secs[4].read_array(offsets, node.width), node)
+    
+    def string_values(self, str_bytes):
+        """Convert a uint8 array with shape (..., number of characters) into an array of strings with shape (...), by viewing the bytes as a 
+        fixed-width numpy.bytes_ array (which removes trailing null characters). This array is converted to str when self.strings=='str'.
+        Missing strings (all bits 1) become empty strings.
+        """
+        str_bytes = np.ascontiguousarray(str_bytes)
+        str_bytes[np.all(str_bytes==255, axis=-1)] = 0
+        values = str_bytes.view('S%d' % str_bytes.shape[-1])[...,0] if str_bytes.shape[-1] else np.zeros(str_bytes.shape[:-1], 'S1')
+        return np.char.decode(values, 'utf-8') if self.strings=='str' else values
+    
+    def scale_values(self, values, node, missing=None):
+        """Convert an array with packed integers for the element given by node to the output type self.dtype. For floats the refval is added, and
+        the result is multiplied by 10**-scale. For raw output the integers are only converted to the smallest type that holds them (the scale and
+        refval are stored in self.metadata['scaling'] by self.add_scaling).
+        missing is a boolean array that indicates missing values, and by default it is determined by comparing the integers with 2**width-1
+        (all bits 1). Missing values become NaN for floats when self.missing=='nan', and when self.missing=='mask' a masked array is returned.
+        values can also be a single integer (a value outside loops for a single subset), which is converted to a numpy scalar in the same way, 
+        without creating arrays. Missing values are then handled by the caller.
+        """
+        refval = self.refvals.get(node.descr, node.refval)
+        if isinstance(values, int):
+            if self.dtype=='raw':
+                return bf.get_uint_dtype(node.width).type(values)
+            dtype = np.dtype(self.dtype)
+            return dtype.type(values+refval)*dtype.type(10.**-node.scale)
+        
+        if missing is None:
+            missing = values==(1 << node.width)-1
+        if self.dtype=='raw':
+            values = values.astype(bf.get_uint_dtype(node.width))
+        else:
+            dtype = np.dtype(self.dtype)
+            values = (values+refval).astype(dtype)*dtype.type(10.**-node.scale)
+            if self.missing=='nan':
+                values[missing] = np.nan
+        return np.ma.MaskedArray(values, missing) if self.missing=='mask' else values
+            
+    def decode_multiple_subsets(self):
+        """Decode section 4 when it contains multiple (uncompressed) subsets. The data for each descriptor is returned as an array over subsets, where
+        the first dimension represents the subsets. Missing values are treated as described in self.scale_values (or empty strings for strings).
         
+        When no delayed replication is used, all subsets have the same layout, and the same number of bits, which is given by the decode plan. 
+        In this case all subsets are decoded at once, by adding the start of each subset to the bit indices that are used for decoding.
+        When delayed replication is used, the subsets can differ in size, and they are decoded one after another. Arrays for descriptors in loops are
+        then stacked when they have the same shape for all subsets, and otherwise an array of type object is returned that contains the array for each
+        subset.
+        """
+        if not self.plan.size is None:
+            subset_bits = self.plan.size
+            if 32+subset_bits*self.n_subsets > len(self.secs[4]):
+                raise Exception('Section 4 is too small for %d subsets of %d bits' % (self.n_subsets, subset_bits))
+            self.decode_subsets(subset_bits*np.arange(self.n_subsets, dtype='int64'))
+            return
         
-        self.d_indices[i] = self.start_descr[i]
-        while True:  
-            d = self.metadata['descr'][self.d_indices[i]]; d_int = int(d)
+        data, data_loops = [], []
+        for i in range(self.n_subsets):
+            self.decode_subsets(np.zeros((), dtype='int64'))
+            data.append(self.data); data_loops.append(self.data_loops)
             
-            if d[0]=='0':
-                self.decode_element_descriptor(d, d_int, decode_data=False)
-                self.d_indices[i] += 1
-                
-            elif d[0]=='1':
-                """First get information about the number of descriptors in the loop, the number of iterations and the total number
-                of bits that is involved in the loop, before proceeding.
-                """
-                self.get_loop_info(i+1, d, d_int)
-                self.d_indices[i] += self.n_descr[i+1] + (2 if d[3:]=='000' else 1)
-                self.n += int(self.n_bits[i+1]*(1-1/self.n_it[i+1]))
-                #Add the number of bits contained in the inner loop(s). Correct for the fact that the first iteration of the inner loop
-                #was already added to self.n
-                                 
-            elif d[0]=='2':
-                self.evaluate_operator(d)
-                self.d_indices[i] += 1
-                
-            if self.d_indices[i]-self.start_descr[i]==self.n_descr[i]:
-                break
+        for d in self.data:
+            for j in range(len(self.data[d])):
+                #The width is taken from the decode plan, since it can be modified by operators
+                node = self.data_nodes[d][j]
+                values = [data[i][d][j] for i in range(self.n_subsets)]
+                if node.typ=='string':
+                    self.data[d][j] = np.array(['' if v is None else v for v in values])
+                    if self.strings=='bytes':
+                        self.data[d][j] = np.char.encode(self.data[d][j], 'utf-8')
+                    continue
+                width = node.width
+                if self.dtype=='raw':
+                    self.data[d][j] = np.array(values, dtype=bf.get_uint_dtype(width))
+                    missing = self.data[d][j]==(1 << width)-1
+                else:
+                    self.data[d][j] = np.array(values, dtype=self.dtype) #None becomes NaN
+                    missing = np.isnan(self.data[d][j])
+                if self.missing=='mask':
+                    self.data[d][j] = np.ma.MaskedArray(self.data[d][j], missing)
+        for i in self.data_loops:
+            for d in self.data_loops[i]:
+                values = [data_loops[k][i].get(d) for k in range(self.n_subsets)]
+                if all([not v is None and v.shape==values[0].shape for v in values]):
+                    self.data_loops[i][d] = np.ma.stack(values) if self.missing=='mask' else np.stack(values)
+                else:
+                    self.data_loops[i][d] = np.empty(self.n_subsets, dtype=object)
+                    self.data_loops[i][d][:] = values
                 
-        self.n_bits[i] = (self.n-np.sum([self.start_n[j] for j in self.start_n if j<=i]))*self.n_it[i]
+    def decode_loop(self, node, base_offsets, n, decode_data=True):
+        """Decode the loop given by node, which starts at bit index base_offsets+n. base_offsets contains the bit indices at which the iterations of the
+        enclosing loops start (for a loop that is not nested it contains the subset offsets, see self.decode_subsets), and n is the position of the loop
+        relative to these bit indices. Returns the position after the loop.
         
-    def get_bits_in_loops(self):
-        """Isolate the bits that are present in a (nested) loop, and reshape them in an (i+1)-dimensional array, where i is the loop ID.
+        First the number of iterations is determined, which is read from the data for delayed replication. For nested loops it is assumed that this
+        number is the same for all iterations of the enclosing loops, such that it is read from the first iteration.
+        Next the number of bits per iteration is determined, which is given by the decode plan, unless it depends on the number of iterations of
+        nested loops. In the latter case it is obtained by walking through the first iteration (function self.get_iteration_size).
+        Then the bit indices at which the iterations start are given by base_offsets[...,np.newaxis] + n + (iteration number * number of bits per 
+        iteration), which results in an array with one more dimension than base_offsets. Finally, the data in the loop is decoded using these bit 
+        indices (function self.decode_data_in_loop).
         """
-        for i in self.start_n:
-            if i==0: continue
+        n_it = node.n_it
+        if node.count_width:
+            n_it = self.secs[4].read(base_offsets.flat[0]+n, node.count_width) if base_offsets.size else 0
+            n += node.count_width
         
-            new_shape = self.bits[i-1].shape[:-1]+(self.n_it[i],int(self.n_bits[i]/self.n_it[i]))
-            self.bits[i] = np.reshape(self.bits[i-1][...,self.start_n[i]:self.start_n[i]+self.n_bits[i]], new_shape)
-            
-    def decode_data_in_loops(self):
-        """Decode the data that is present in the loops. The data for each descriptor has a dimensionality that is 1 lower than the dimensionality of the
-        loop in which it resides, because during the decoding process, summation takes place over the last dimension.
+        if n_it==0:
+            size = 0
+        elif node.size is None:
+            size = self.get_iteration_size(node.body, base_offsets.flat[0]+n)
+        else:
+            size = node.size
+        
+        if decode_data:
+            offsets = base_offsets[...,np.newaxis] + (n + size*np.arange(n_it, dtype='int64'))
+            self.decode_data_in_loop(node.body, offsets)
+        return n + size*n_it
+    
+    def get_iteration_size(self, nodes, n):
+        """Returns the number of bits in one iteration of a loop that contains the given nodes, and that starts at bit index n. Delayed replication factors
+        of nested loops are read from the data.
         """
-        for i in self.bits:
-            if i==0: continue
-            n = 0
-            
-            d_list = self.metadata['descr'][self.start_descr[i]:self.start_descr[i]+self.n_descr[i]]
-            for d in d_list:
-                d_int = int(d)
+        n_start = n
+        for node in nodes:
+            if isinstance(node, decode_plan.Loop):
+                n_it = node.n_it
+                if node.count_width:
+                    n_it = self.secs[4].read(n, node.count_width)
+                    n += node.count_width
+                if n_it > 0:
+                    n += n_it*(node.size if not node.size is None else self.get_iteration_size(node.body, n))
+            else:
+                n += node.width
+        return n-n_start
+    
+    def decode_data_in_loop(self, nodes, offsets):
+        """Decode the data that is present in a loop, for which the iterations start at the bit indices given in offsets. The data for each descriptor 
+        has the same shape as offsets, and is obtained by gathering the values at bit indices offsets+n from the packed bytes, where n is the position
+        of the descriptor within one iteration of the loop.
+        """
+        n = 0
+        for node in nodes:
+            d = node.descr
+            if isinstance(node, decode_plan.Loop):
+                n = self.decode_loop(node, offsets, n)
+            elif isinstance(node, decode_plan.RefvalRedefinition):
+                if offsets.size:
+                    self.refvals[d] = self.secs[4].read_signed(offsets.flat[0]+n, node.width)
+                n += node.width
+            else:
+                if isinstance(self.read_mode,str) or d in self.read_mode:
+                    #if self.read_mode is not a string, then it should be a list with descriptors for which data should be decoded.
+                    self.add_scaling(node, self.base_loop_i)
+                    if node.typ=='string':
+                        self.data_loops[self.base_loop_i][d] = self.string_values(self.secs[4].read_bytes_array(offsets+n, node.width//8))
+                    else:
+                        #Missing values are detected on the packed integers, see self.scale_values
+                        self.data_loops[self.base_loop_i][d] = self.scale_values(self.secs[4].read_array(offsets+n, node.width), node)
+                n += node.width
                 
-                if d[0]=='0' and not d[:3]=='031': #Prevent the evaluation of delayed replication operators
-                    
-                    if isinstance(self.read_mode,str) or d in self.read_mode:
-                        #if self.read_mode is not a string, then it should be a list with descriptors for which data should be decoded.
-                        typ = self.tables.tab_b[d_int].typ
-                        if typ=='string':
-                            raise Exception('Decoding strings in loops is not (yet) supported')
-                        else:
-                            self.data_loops[self.base_loop_i][d] = (bf.bits_to_n(self.bits[i][...,n:n+self.widths[d]])+self.refvals[d])/10**self.scales[d]
-                            
-                    n += self.widths[d]
-                        
-                elif d[0]=='1':
-                    #Skip the bits that belong to the loop, because they are treated when treating the next loop
-                    #Also skip the bits for a possible delayed replication descriptor
-                    n += self.n_bits[i+1] + self.loopdescr_widths[i+1] 
+                
+                
+    def decode_section4_compressed(self):
+        """Decode section 4 for a BUFR in which the data is compressed. In this case section 4 contains for each element, for all subsets together,
+        a reference value R0 (with the width of the element), a 6-bit number NBINC, and then for each subset an increment of NBINC bits. The value 
+        for a subset is R0 plus its increment, and when NBINC is 0, all subsets have the value R0 (and no increments are given). 
+        Values (R0 or an increment) for which all bits are 1 indicate missing values.
+        Because the increments for all subsets are located next to each other, they can be decoded at once by the bit reader.
+        
+        The data for an element is an array over subsets, in which missing values are treated as described in self.scale_values. Strings are returned as an array of str. 
+        Replication factors are the same for all subsets, and loops are therefore unrolled in the same way for all subsets. The data for an element
+        in a loop is an array with shape (number of subsets, number of iterations of loop 1, ..., number of iterations of loop i), where loop i
+        is the (nested) loop in which the element resides. Nested loops should therefore have the same number of iterations for each iteration
+        of the enclosing loop.
+        """
+        for node in self.plan.nodes:
+            if isinstance(node, decode_plan.Loop):
+                self.loop_values = {} #Contains for each descriptor index in the loop a list with the data for each iteration
+                self.loop_shapes = {} #Contains for each descriptor index in the loop the number of iterations for the loops in which it resides
+                self.decode_loop_compressed(node, ())
+                
+                for j in self.loop_values:
+                    d_loop = self.metadata['descr'][j]
+                    values = self.loop_values[j]
+                    if len(values) != np.prod(self.loop_shapes[j]):
+                        raise Exception('Nested loops with a varying number of iterations are not (yet) supported for compressed data')
+                    values = np.ma.stack(values) if self.missing=='mask' else np.array(values)
+                    values = np.reshape(values, self.loop_shapes[j]+(self.n_subsets,))
+                    self.data_loops[self.base_loop_i][d_loop] = np.moveaxis(values, -1, 0)
                     
-                """No evaluation of operators is required anymore, because the width, scale and refval have already been determined
-                during evaluation of the function self.get_loop_info.
-                """
\ No newline at end of file
+                self.base_loop_i += 1
+                self.data_loops[self.base_loop_i] = {}
+            else:
+                self.decode_node_compressed(node, ())
+                
+    def decode_loop_compressed(self, node, loop_shape):
+        """Unroll the loop given by node. loop_shape contains the number of iterations of the loops in which this loop is nested.
+        """
+        n_it = node.n_it
+        if node.count_width:
+            #The delayed replication factor is compressed like any other element, but it must be the same for all subsets, such that NBINC is 0.
+            n_it = self.secs[4].read(self.n, node.count_width)
+            nbinc = self.secs[4].read(self.n+node.count_width, 6)
+            self.n += node.count_width+6+self.n_subsets*nbinc
+        
+        loop_shape = loop_shape+(n_it,)
+        for it in range(n_it):
+            for child in node.body:
+                if isinstance(child, decode_plan.Loop):
+                    self.decode_loop_compressed(child, loop_shape)
+                else:
+                    self.decode_node_compressed(child, loop_shape)
+                
+    def decode_node_compressed(self, node, loop_shape):
+        """Decode the element given by node. loop_shape is empty when the element is not located inside a loop.
+        """
+        d = node.descr
+        in_loop = len(loop_shape)>0
+        if in_loop:
+            decode_data = self.read_mode!='outside_loops' and (isinstance(self.read_mode,str) or d in self.read_mode)
+        else:
+            decode_data = True
+        values = self.decode_element_descriptor_compressed(node, decode_data)
+        
+        if not values is None:
+            if in_loop:
+                if not node.index in self.loop_values:
+                    self.add_scaling(node, self.base_loop_i)
+                self.loop_values.setdefault(node.index, []).append(values)
+                self.loop_shapes[node.index] = loop_shape
+            else:
+                self.add_scaling(node)
+                self.data.setdefault(d, []).append(values)
+        
+    def decode_element_descriptor_compressed(self, node, decode_data=True):
+        """Returns an array with the values for all subsets, or None if no data is decoded.
+        """
+        if isinstance(node, decode_plan.RefvalRedefinition):
+            #The new reference value is compressed in the same way as other elements, but should be equal for all subsets
+            self.refvals[node.descr] = self.secs[4].read_signed(self.n, node.width)
+            nbinc = self.secs[4].read(self.n+node.width, 6)
+            self.n += node.width+6+self.n_subsets*nbinc
+            return None
+        
+        width = node.width
+        R0 = self.secs[4].read(self.n, width)
+        nbinc = self.secs[4].read(self.n+width, 6)
+        n_start = self.n+width+6 #Start of the increments
+        self.n = n_start+self.n_subsets*nbinc*(8 if node.typ=='string' else 1)
+        if not decode_data:
+            return None
+        
+        if node.typ=='string':
+            #For strings R0 is 0, and NBINC gives the number of characters for each subset. If NBINC is 0, then all subsets have the string
+            #given by R0.
+            if nbinc==0:
+                str_bytes = self.secs[4].read_bytes_array(np.full(self.n_subsets, n_start-width-6), width//8)
+            else:
+                str_bytes = self.secs[4].read_bytes_array(n_start+8*nbinc*np.arange(self.n_subsets), nbinc)
+            return self.string_values(str_bytes)
+        
+        if nbinc==0:
+            values = np.full(self.n_subsets, R0, dtype='int64')
+            missing = np.full(self.n_subsets, R0==(1 << width)-1)
+        else:
+            increments = self.secs[4].read_array(n_start+nbinc*np.arange(self.n_subsets), nbinc)
+            missing = increments==(1 << nbinc)-1
+            values = R0+increments
+        if self.dtype=='raw':
+            values[missing] = (1 << width)-1 #As for uncompressed data
+        return self.scale_values(values, node, missing)
@@ -7,22 +7,20 @@ Created on Sat Feb 10 14:17:27 2018
 
 Is for a large part based on/ copied from the script trollbufr/read/bufr_sect.py from Alex Maul, see: https://github.com/alexmaul/trollbufr
 """
-import numpy as np
-
 from . import bufr_functions as bf
 
 
 
 
 def decode_sect0(sec0):
-    """
+    """sec0 is a bit reader for section 0.
     RETURN offset, length, {size, edition}
     """
-    if str(np.packbits(sec0[:32]),'utf-8') != "BUFR":
+    if sec0.read_bytes(0, 4) != b"BUFR":
         return {}
     
-    size = bf.bits_to_n(sec0[32:56])
-    edition = bf.bits_to_n(sec0[-8:])
+    size = sec0.read(32, 24)
+    edition = sec0.read(56, 8)
     return {'size':size, 'edition':edition}
 
 
@@ -69,7 +67,7 @@ BUFR Vers. 4
 (22-n Reserved)
 """
 def decode_sect1(sec1, edition=3):
-    """
+    """sec1 is a bit reader for section 1.
     RETURN offset, length, {master, center, subcenter, update, cat, cat_int, cat_loc, mver, lver, datetime, sect2}
     """
     key_offs = {
@@ -89,9 +87,9 @@ def decode_sect1(sec1, edition=3):
     meta_dict = {}
     for t in key_offs[edition]:
         if t[0]=='datetime':
-            meta_dict[t[0]] = bf.dtg(sec1[t[1]*8:(t[2]+1)*8], edition)
+            meta_dict[t[0]] = bf.dtg(sec1, t[1]*8, edition)
         else:
-            meta_dict[t[0]] = bf.bits_to_n(sec1[t[1]*8:(t[2]+1)*8])
+            meta_dict[t[0]] = sec1.read(t[1]*8, (t[2]-t[1]+1)*8)
     meta_dict['sect2'] = meta_dict['sect2'] & 128
 
     return meta_dict
@@ -109,17 +107,21 @@ Section 3
         F=0: element/Tab.B, F=1: repetition, F=2: operator/Tab.C, F=3: sequence/Tab.D
 """
 def decode_sect3(sec3, sec3_length):
-    """Get the list of data descriptors that is given in section 3
+    """Get the number of subsets, the flags for observed and compressed data, and the list of data descriptors that is given in section 3.
+    sec3 is a bit reader for section 3, and sec3_length its length in bits.
     """
-    desc_start = 56 #Index at which the listing of data descriptors starts
-    desc_end = sec3_length-int(np.mod(desc_start,16))
-    desc_range = desc_end-desc_start
+    subsets = sec3.read(32, 16)
+    flag = sec3.read(48, 8)
     
-    n_descriptors = int(desc_range/16) #Descriptors are represented by 16 bits according to the FXY format,
+    desc_start = 7 #Octet at which the listing of data descriptors starts
+    n_descriptors = int((sec3_length/8-desc_start)/2) #Descriptors are represented by 16 bits according to the FXY format,
     #where F represents the type of descriptor, X its class, and Y its number within that class. F is represented by the first
-    #2 bits, X by the next 6, and Y by the last 8.
-    sec3_reshaped = np.reshape(sec3[desc_start:desc_end], (n_descriptors,int(desc_range/n_descriptors)))
-    F = bf.bits_to_n(sec3_reshaped[:,:2]); X = bf.bits_to_n(sec3_reshaped[:,2:8]); Y = bf.bits_to_n(sec3_reshaped[:,8:])
+    #2 bits, X by the next 6, and Y by the last 8. A possible padding octet at the end of the section is not included.
+    
+    #The octets are taken directly from the packed section, without expanding them into bits.
+    fxy = sec3.bytes[desc_start:desc_start+2*n_descriptors].reshape((n_descriptors, 2)).astype('uint16')
+    F = fxy[:,0] >> 6; X = fxy[:,0] & 63; Y = fxy[:,1]
     
-    descriptors = [str(F[j])+format(X[j],'02')+format(Y[j],'03') for j in range(n_descriptors)]
-    return {'descr':descriptors}
\ No newline at end of file
+    #The descriptors are represented by the integers FXXYYY, e.g. 21014 for descriptor 021014. The string form is only used for the decoded results.
+    descriptors = F.astype('int64')*100000 + X.astype('int64')*1000 + Y
+    return {'subsets':subsets, 'obs':flag & 128 > 0, 'comp':flag & 64 > 0, 'descr':descriptors}
\ No newline at end of file
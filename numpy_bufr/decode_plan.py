@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Compilation of the (expanded) list of data descriptors into a decode plan.
+
+Interpreting the descriptors requires parsing their FXY format, looking up the width, scale and refval of each element in table B, and evaluating
+the operators that modify them. For a given template (the list of descriptors in section 3) and set of tables, the result of this interpretation is
+always the same, while the same template is often received many times (DWD sends the same radar template thousands of times a day).
+The interpretation is therefore done once, by compiling the descriptors into an immutable decode plan, which is stored in an LRU cache that is keyed
+by the template and the tables. When decoding section 4 with the plan, only the delayed replication factors need to be read from the data.
+
+A plan consists of a tuple of nodes, where each node is one of the following:
+    Element: an element descriptor, with the width, scale and refval that apply after evaluation of the operators.
+    RefvalRedefinition: an element descriptor for which section 4 contains a new reference value, instead of data (operator 203YYY).
+    Loop: a replication operator, with the number of iterations (0 for delayed replication), the width of the delayed replication factor (0 if not
+    present), the nodes in the loop, and the number of bits per iteration (None when this number depends on delayed replication factors).
+"""
+from collections import namedtuple, OrderedDict
+import numpy as np
+
+from . import bufr_functions as bf
+
+
+
+Element = namedtuple('Element', ['index', 'descr', 'typ', 'width', 'scale', 'refval'])
+RefvalRedefinition = namedtuple('RefvalRedefinition', ['index', 'descr', 'width'])
+Loop = namedtuple('Loop', ['index', 'descr', 'n_it', 'count_width', 'body', 'size'])
+#index gives the index of the descriptor in the expanded list of descriptors, and descr the descriptor in string form (as used in the results).
+
+DecodePlan = namedtuple('DecodePlan', ['descr', 'full_description', 'nodes', 'size', 'source'])
+#descr is the expanded list of descriptors (in string form), and size the number of bits required for the data of one subset (None when it depends
+#on delayed replication factors). source gives for each descriptor the sequence descriptor (table D) from which it originates, which is useful for
+#diagnostics (-1 for descriptors that are not part of a sequence).
+
+
+class PlanCache():
+    def __init__(self, max_size=256):
+        """LRU cache for decode plans, which keeps at most max_size plans.
+        """
+        self.max_size = max_size
+        self.plans = OrderedDict()
+
+    def __len__(self):
+        return len(self.plans)
+
+    def get(self, key):
+        """Returns the plan for key, or None if it is not present.
+        """
+        plan = self.plans.get(key)
+        if not plan is None:
+            self.plans.move_to_end(key)
+        return plan
+
+    def add(self, key, plan):
+        self.plans[key] = plan
+        self.plans.move_to_end(key)
+        while len(self.plans) > self.max_size:
+            self.plans.popitem(last=False)
+
+plans = PlanCache()
+
+
+
+def compile_plan(descr, tables, full_description=(), source=None):
+    """Compile the expanded array of descriptors descr (integers FXXYYY, in which sequence descriptors have been replaced), using the table B given
+    in tables.
+    """
+    operator_state = {'add_width':0, 'add_scale':0, 'redefining_refval_width':0}
+    descr = np.asarray(descr, dtype='int64')
+    F, X, Y = bf.split_fxy(descr)
+    fxy = (F.tolist(), X.tolist(), Y.tolist())
+    descr_str = bf.descr_to_str(descr)
+    elements = lookup_elements(descr, F, tables)
+    nodes = compile_nodes(descr_str, fxy, 0, len(descr), elements, operator_state)
+    source = (-1,)*len(descr) if source is None else tuple(np.asarray(source).tolist())
+    return DecodePlan(tuple(descr_str), tuple(full_description), nodes, get_size(nodes), source)
+
+def lookup_elements(descr, F, tables):
+    """Look up all element descriptors (for which F is 0) in descr at once in table B. Returns a list with for each descriptor (typ, width, scale, 
+    refval), or None when it is not an element descriptor or not present in table B.
+    """
+    tab_b = tables.tab_b
+    rows = tab_b.get_rows(np.where(F==0, descr, -1))
+    elements = [None]*len(descr)
+    found = np.nonzero(rows != -1)[0]
+    if len(found):
+        r = rows[found]
+        typ = [tables.type_list[t] for t in tab_b.typ[r]]
+        for j, e in zip(found.tolist(), zip(typ, tab_b.width[r].tolist(), tab_b.scale[r].tolist(), tab_b.refval[r].tolist())):
+            elements[j] = e
+    return elements
+
+def compile_nodes(descr, fxy, start, end, elements, operator_state):
+    """Compile the descriptors descr[start:end] into a tuple of nodes, where descr contains the descriptors in string form, fxy the lists F, X and Y,
+    and elements the table B entry for each descriptor (see the function lookup_elements). Operators are evaluated during compilation, by modifying
+    operator_state.
+    """
+    F, X, Y = fxy
+    nodes = []
+    j = start
+    while j < end:
+        d = descr[j]
+        if F[j]==0:
+            if operator_state['redefining_refval_width']:
+                nodes.append(RefvalRedefinition(j, d, operator_state['redefining_refval_width']))
+            else:
+                if elements[j] is None:
+                    raise KeyError(int(d))
+                typ, width, scale, refval = elements[j]
+                nodes.append(Element(j, d, typ, width+operator_state['add_width'], scale+operator_state['add_scale'], refval))
+            j += 1
+        elif F[j]==1:
+            """In the loop operator (FXY), X gives the number of descriptors that is included in the loop, i.e. '110000' means that 10 descriptors
+            are included. Y gives the the number of iterations in the loop, and is zero when this number is set by a delayed descriptor of the
+            format '031YYY', which is not included in the number of descriptors.
+            """
+            n_descr = X[j]; n_it = Y[j]
+            if n_it==0:
+                if elements[j+1] is None:
+                    raise KeyError(int(descr[j+1]))
+                count_width = elements[j+1][1]
+                body_start = j+2
+            else:
+                count_width = 0
+                body_start = j+1
+            body = compile_nodes(descr, fxy, body_start, body_start+n_descr, elements, operator_state)
+            nodes.append(Loop(j, d, n_it, count_width, body, get_size(body)))
+            j = body_start+n_descr
+        else:
+            if F[j]==2:
+                evaluate_operator(X[j], Y[j], operator_state)
+            j += 1
+    return tuple(nodes)
+
+def evaluate_operator(X, Y, operator_state):
+    """In this case the descriptor 2XXYYY represents an operator.
+    See the file operator.TABLE in the table directory for their interpretation.
+    """
+    if X==1:
+        #Change the data width
+        operator_state['add_width'] = 0 if Y==0 else Y-128
+    elif X==2:
+        #Change the scale
+        operator_state['add_scale'] = 0 if Y==0 else Y-128
+    elif X==3:
+        #Redefine reference values, which are given in section 4 with the width given by YYY
+        operator_state['redefining_refval_width'] = Y if Y!=255 else 0
+
+def get_size(nodes):
+    """Returns the number of bits required for the data of the nodes, or None when this depends on delayed replication factors.
+    """
+    size = 0
+    for node in nodes:
+        if isinstance(node, Loop):
+            if node.count_width or node.size is None:
+                return None
+            size += node.n_it*node.size
+        else:
+            size += node.width
+    return size
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Fast scanning of the metadata of BUFR messages in many files, without loading tables or decoding data.
+
+For selecting files (e.g. by centre, data category, time or template) only sections 0, 1 and 3 are needed, which together are usually no more than a
+few hundred bytes at the start of a message. scan_headers therefore reads only this part of each message, and uses the total length of a message
+that is given in section 0 to jump directly to the next message. Of compressed files only the part that is needed is decompressed, such that
+obtaining the metadata of the first message of a compressed file does not require decompressing the complete file.
+
+The metadata is returned as a record array with one row per message, which can be filtered with the usual numpy operations.
+"""
+import glob
+import hashlib
+import numpy as np
+
+from . import decode_metadata
+from . import stream
+from .bit_reader import BitReader
+
+
+
+header_dtype = [('offset', 'int64'), ('length', 'int64'), ('codec', 'U4'), ('edition', 'uint8'), ('master', 'uint8'), ('center', 'uint16'),
+                ('subcenter', 'uint16'), ('update', 'uint8'), ('cat', 'uint8'), ('cat_int', 'uint8'), ('cat_loc', 'uint8'), ('mver', 'uint8'),
+                ('lver', 'uint8'), ('datetime', 'datetime64[s]'), ('subsets', 'uint16'), ('obs', 'bool'), ('comp', 'bool'), ('n_descr', 'uint16'),
+                ('template', 'uint64')]
+#offset is the byte index at which a message starts in the (decompressed) content of a file, length its total length in bytes, and codec the
+#compression of the file ('' if it is not compressed). template is a hash of the list of descriptors in section 3 (see template_hash).
+
+def template_hash(descr):
+    """Returns a 64-bit hash of the (unexpanded) array of descriptors descr (integers FXXYYY) that is given in section 3, which identifies the
+    template of a message.
+    """
+    descr = np.ascontiguousarray(descr, dtype='<i8')
+    return int.from_bytes(hashlib.blake2b(descr.tobytes(), digest_size=8).digest(), 'little')
+
+def scan_headers(paths, prefix_size=512, max_messages=None):
+    """Returns a record array (with the fields in header_dtype, preceded by the field 'path') with the metadata of each BUFR message in the files
+    given by paths, which can be a list of paths or a glob pattern.
+    Per message only the bytes up to the end of section 3 are read (in steps of prefix_size bytes), and no tables are loaded.
+    max_messages can be used to limit the number of messages that is scanned per file. For compressed files this is important for speed, since the
+    content before a message needs to be decompressed in order to reach it. With max_messages=1 only the start of a compressed file is decompressed.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    rows = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            codec = stream.detect_codec(f.read(8))
+            f.seek(0)
+            headers = scan_file(f, prefix_size, max_messages)
+            rows += [(path,)+h[:2]+(codec or '',)+h[2:] for h in headers]
+
+    path_width = max([len(p) for p in paths]+[1])
+    dtype = np.dtype([('path', 'U%d' % path_width)]+header_dtype)
+    return np.array(rows, dtype=dtype).view(np.recarray)
+
+def scan_file(f, prefix_size=512, max_messages=None):
+    """Returns a list with a tuple (offset, length, edition, ...) for each message in the binary file object f, in the order of header_dtype (without
+    codec). The boundaries of the messages are determined with stream.iter_messages, which yields only the bytes up to the end of section 3 of each
+    message, read in steps of prefix_size bytes. The data of the messages in uncompressed files is skipped with seeks. Messages of which the header
+    can't be decoded are skipped.
+    """
+    headers = []
+    for offset, length, prefix in stream.iter_messages(f, prefix_size, get_header_size, max_messages):
+        header = decode_header(prefix)
+        if not header is None:
+            headers.append((offset,)+header)
+    return headers
+
+def get_header_size(data):
+    """Returns the number of bytes from the start of a message up to the end of section 3, where data contains (at least the start of) the message.
+    Returns None when data is too short for determining this number, and 0 when the lengths of the sections don't fit within the total length of
+    the message (which is then not valid).
+    """
+    if len(data) < 11:
+        return None
+    length = int.from_bytes(data[4:7], 'big')
+    edition = data[7]
+    n = 8+int.from_bytes(data[8:11], 'big') #Start of section 2 or 3
+    flag_index = 8+(7 if edition < 4 else 9) #Octet in section 1 that indicates whether section 2 is present
+    if n+3 > length:
+        return 0
+    if len(data) < max(n, flag_index+1)+3:
+        return None
+    if data[flag_index] & 128:
+        n += int.from_bytes(data[n:n+3], 'big')
+        if n+3 > length:
+            return 0
+        if len(data) < n+3:
+            return None
+    size = n+int.from_bytes(data[n:n+3], 'big')
+    return size if size+4 <= length else 0
+
+def decode_header(data):
+    """Decodes sections 0, 1 and 3 of the message at the start of data, which must contain at least the bytes up to the end of section 3. 
+    Returns a tuple with the values of the fields in header_dtype from length onwards (without codec), or None when data does not start with a valid
+    message (which could for example be a false start).
+    """
+    size = get_header_size(data)
+    if data[:4] != b'BUFR' or not data[7] in (2, 3, 4) or not size or size > len(data):
+        return None
+    
+    reader = BitReader(bytes(data[:size]))
+    meta = decode_metadata.decode_sect0(reader.section(0, 8))
+    sec1_length = reader.read(64, 24)
+    sec3_start = 8+sec1_length
+    try:
+        meta.update(decode_metadata.decode_sect1(reader.section(8, sec3_start), meta['edition']))
+        if meta['sect2']:
+            sec3_start += reader.read(8*sec3_start, 24)
+        meta.update(decode_metadata.decode_sect3(reader.section(sec3_start, size), 8*(size-sec3_start)))
+    except (IndexError, ValueError):
+        #A section is too short for its content, or an invalid date is given
+        return None
+    
+    return (meta['size'], meta['edition'], meta['master'], meta['center'], meta['subcenter'], meta['update'], meta['cat'], meta['cat_int'],
+            meta['cat_loc'], meta['mver'], meta['lver'], np.datetime64(meta['datetime'], 's'), meta['subsets'], meta['obs'], meta['comp'], len(meta['descr']),
+            template_hash(meta['descr']))
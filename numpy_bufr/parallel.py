@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel decoding of the messages in a file with a pool of worker processes.
+
+Each message is decoded independently of the other messages, such that messages can be distributed over processes. The main process extracts the
+messages from the file (see DecodeBUFR.iter_message_bytes), and sends only the bytes of a message to a worker, not the complete content of the file.
+Each worker has its own decoder, which is created once when the worker starts. The tables that it loads (load_tables.loaded_tables) and the decode
+plans that it compiles (decode_plan.plans) therefore remain cached in the worker for all messages that it decodes.
+The results are returned in the order of the messages. At most a few messages per worker are submitted ahead of the message whose result is
+returned next, such that the memory usage doesn't depend on the number of messages in the file. The pools that are used for this are kept in
+pools, such that the workers (with their tables and plans) are reused when the next file is decoded with the same settings.
+
+The same pool is used for decoding many files with the class BatchDecoder, which keeps the pool alive between batches. Starting the processes,
+importing the modules and loading the tables are then done once per worker, instead of once per file. The tables can be loaded when a worker
+starts, by decoding the metadata of a representative file (warmup_path).
+This module can also be run as a script, e.g. python -m numpy_bufr.parallel <table_path> eccodes "data/*.buf", which reports the number of files
+decoded per second.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import collections
+import concurrent.futures
+
+from . import decode_bufr
+
+
+
+decoder = None #The decoder of a worker process
+pools = {} #Pools used by decode_messages, with key (n_processes, table_path, table_type)
+
+def init_worker(table_path, table_type, warmup_path=None):
+    global decoder
+    decoder = decode_bufr.DecodeBUFR(table_path, table_type)
+    if not warmup_path is None:
+        try:
+            #Decoding only the data outside loops is sufficient for loading the tables and compiling the decode plans
+            decoder(warmup_path, read_mode='outside_loops')
+        except Exception:
+            pass #Errors are reported when the file is decoded as part of a batch
+    
+def decode_message(message, options):
+    """Decode one message (given as bytes) in a worker process. Returns (metadata, full_description, data, data_loops) for the message.
+    options contains the keyword arguments for DecodeBUFR.iter_messages (e.g. read_mode).
+    """
+    return next(decoder.iter_messages(message, msg_offsets=[0], **options))
+
+def decode_file(file_path, options):
+    """Decode all messages in a file in a worker process. Returns (file_path, result, error), where result is the output of DecodeBUFR.__call__,
+    and error the exception that occurred during decoding (if any, in which case result is None).
+    """
+    try:
+        return file_path, decoder(file_path, **options), None
+    except Exception as e:
+        return file_path, None, e
+
+def create_pool(n_processes, table_path, table_type, warmup_path=None):
+    return concurrent.futures.ProcessPoolExecutor(n_processes, initializer=init_worker, initargs=(table_path, table_type, warmup_path))
+
+def submit_ordered(pool, function, iterable, max_pending):
+    """Submits function(*args) to the pool for each tuple args in iterable, and yields the futures in the order of iterable. At most max_pending
+    calls are submitted ahead of the future that is yielded. Calls that have not started yet are cancelled when the generator is closed early.
+    """
+    pending = collections.deque()
+    try:
+        for args in iterable:
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= max_pending:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+        
+def get_pool(n_processes, table_path, table_type):
+    """Returns the pool in pools for these arguments, which is created when it doesn't exist yet.
+    """
+    key = (n_processes, table_path, table_type)
+    if not key in pools:
+        pools[key] = create_pool(n_processes, table_path, table_type)
+    return pools[key]
+
+def shutdown_pools():
+    #Stop the workers of all pools used by decode_messages
+    for pool in pools.values():
+        pool.shutdown(cancel_futures=True)
+    pools.clear()
+        
+def decode_messages(messages, n_processes, table_path, table_type, pool=None, **options):
+    """Decode the messages (an iterable of bytes objects) with a pool of n_processes worker processes. Yields (metadata, full_description, data, 
+    data_loops) for each message, in the order of the messages. options are passed to DecodeBUFR.iter_messages (e.g. read_mode).
+    By default a pool from pools is used (see get_pool), which remains alive for later calls. Another pool can be given with pool (e.g. that of a 
+    BatchDecoder), in which case its workers should use the same tables.
+    """
+    key = (n_processes, table_path, table_type)
+    if pool is None:
+        pool = get_pool(*key)
+    try:
+        for future in submit_ordered(pool, decode_message, ((message, options) for message in messages), 2*n_processes):
+            yield future.result()
+    except concurrent.futures.process.BrokenProcessPool:
+        #A worker has died, after which the pool can't be used anymore. A new pool is created at the next call.
+        if pools.get(key) is pool:
+            del pools[key]
+        raise
+
+
+
+class BatchDecoder():
+    def __init__(self, table_path, table_type='eccodes', n_processes=None, warmup_path=None):
+        """Decoder for batches of files, that uses a persistent pool of n_processes worker processes (by default one per CPU). If warmup_path is
+        given, then each worker loads the tables for this file when it starts.
+        Call self.close() (or use the decoder as a context manager) to stop the workers.
+        """
+        self.n_processes = os.cpu_count() if n_processes is None else n_processes
+        self.pool_args = (self.n_processes, table_path, table_type, warmup_path)
+        self.pool = create_pool(*self.pool_args)
+        self.stats = {'files':0, 'errors':0, 'seconds':0., 'files_per_second':0.}
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+        
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        
+    def restart_pool(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = create_pool(*self.pool_args)
+        
+    def __call__(self, file_paths, **options):
+        """Yields (file_path, result, error) for each file in file_paths, in the given order, where result is the output of DecodeBUFR.__call__ for
+        the file, with keyword arguments options (e.g. read_mode). file_paths can be a list (or other iterable) of paths, or a glob pattern. 
+        An error in one file doesn't affect the other files: It is returned as error (with result None), and decoding continues. When a worker dies
+        (e.g. due to a segmentation fault, or because it is killed when running out of memory), the pool can't be used anymore. The files that were
+        being decoded by the pool at that moment are then returned with the BrokenProcessPool exception as error, and the remaining files are 
+        decoded by a new pool.
+        Statistics for the batch (including the number of files decoded per second) are stored in self.stats, which is updated while the results
+        are yielded.
+        """
+        if isinstance(file_paths, str):
+            file_paths = sorted(glob.glob(file_paths))
+        #The paths are used both for submitting the files and for reporting errors, so an iterator can't be used for both
+        file_paths = list(file_paths)
+        self.stats = {'files':0, 'errors':0, 'seconds':0., 'files_per_second':0.}
+        t_start = time.time()
+        
+        pending = collections.deque() #Contains (file_path, future, pool) for the files that have been submitted, in the order of file_paths
+        remaining = iter(file_paths)
+        while True:
+            #At most 4 files per worker are submitted ahead of the file whose result is returned next
+            for file_path in remaining:
+                try:
+                    future = self.pool.submit(decode_file, file_path, options)
+                except concurrent.futures.process.BrokenProcessPool:
+                    #The pool broke before the failing file was reached below
+                    self.restart_pool()
+                    future = self.pool.submit(decode_file, file_path, options)
+                pending.append((file_path, future, self.pool))
+                if len(pending) >= 4*self.n_processes:
+                    break
+            if not pending:
+                break
+            
+            file_path, future, pool = pending.popleft()
+            try:
+                file_path, result, error = future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                #A worker has died. All files that are still pending in the same pool fail in the same way, and a new pool is created for the
+                #remaining files.
+                result, error = None, e
+                if pool is self.pool:
+                    self.restart_pool()
+            except Exception as e:
+                #E.g. a result that can't be transferred from the worker
+                result, error = None, e
+                
+            self.stats['files'] += 1
+            self.stats['errors'] += error is not None
+            self.stats['seconds'] = time.time()-t_start
+            self.stats['files_per_second'] = self.stats['files']/max(self.stats['seconds'], 1e-9)
+            yield file_path, result, error
+            
+            
+            
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode a batch of BUFR files with a pool of worker processes.')
+    parser.add_argument('table_path')
+    parser.add_argument('table_type', help="'eccodes', 'libdwd' or 'bufrdc'")
+    parser.add_argument('file_paths', nargs='+', help='Paths or glob patterns')
+    parser.add_argument('-n', '--n_processes', type=int, default=None)
+    parser.add_argument('--read_mode', default='all', help="'all' or 'outside_loops'")
+    parser.add_argument('--dtype', default='float64', help="'float64', 'float32' or 'raw'")
+    args = parser.parse_args()
+    
+    file_paths = [p for pattern in args.file_paths for p in (sorted(glob.glob(pattern)) or [pattern])]
+    with BatchDecoder(args.table_path, args.table_type, args.n_processes, file_paths[0] if file_paths else None) as batch_decoder:
+        for file_path, result, error in batch_decoder(file_paths, read_mode=args.read_mode, dtype=args.dtype):
+            if not error is None:
+                print('%s: %s' % (file_path, repr(error)), file=sys.stderr)
+        stats = batch_decoder.stats
+    print('Decoded %d files in %.2f s (%.1f files/s), %d errors' % (stats['files'], stats['seconds'], stats['files_per_second'], stats['errors']))
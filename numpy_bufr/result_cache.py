@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for decoded results, which can be placed in front of DecodeBUFR (see its argument result_cache).
+
+The same message is often decoded many times (e.g. by dashboards that show the latest radar sweeps, or by reprocessing jobs). The result of decoding
+a message is completely determined by its bytes, the tables and the decoding options, so these are combined into a key (using a fast hash of the
+bytes of the message), under which the result is stored.
+
+Each entry is a directory that contains the arrays of the result as .npy files, and the remaining structure of the result (dictionaries, lists,
+and scalar values) in a pickle, in which the arrays are replaced by references. When an entry is loaded, the arrays are memory-mapped, such that a
+cache hit costs little more than mapping the files. The arrays that are returned for a cache hit are therefore read-only.
+
+The total size of the cache is limited to max_size bytes, by removing the least recently used entries. Since the tables are identified by their
+key (path, versions, centre and subcentre), the cache should be cleared when the table files are modified.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import uuid
+import numpy as np
+
+
+
+class ArrayRef():
+    __slots__ = ('name', 'masked')
+    def __init__(self, name, masked=False):
+        """Reference to the array stored in the file name+'.npy' of an entry. For a masked array the mask is stored in name+'_mask.npy'.
+        """
+        self.name = name
+        self.masked = masked
+
+class ResultCache():
+    def __init__(self, cache_dir, max_size=1 << 30):
+        """cache_dir is the directory in which the entries are stored, and max_size the maximum total size of the entries in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries = None #Dictionary with the size of each entry, which is determined when it is first needed
+
+    def get_key(self, message, table_key, read_mode, **options):
+        """Returns the key for the result of decoding message (any object that supports the buffer protocol) with the tables given by table_key,
+        read_mode, and the other options of DecodeBUFR.iter_messages (e.g. dtype) that affect the result.
+        """
+        h = hashlib.blake2b(message, digest_size=16)
+        h.update(repr((table_key, read_mode, sorted(options.items()))).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns the cached result for key, or None if it is not present. The arrays in the result are memory-mapped.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, 'structure.pkl'), 'rb') as f:
+                structure = pickle.load(f)
+            result = self.restore(structure, entry_dir)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            #Not present, or removed (or written) by another process in the meantime
+            return None
+        #The modification time of the entry determines the order in which entries are removed
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        return result
+
+    def add(self, key, result):
+        """Store result under key. The entry is first written to a temporary directory, which is then renamed, such that other processes never see
+        incomplete entries.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = os.path.join(self.cache_dir, 'tmp_'+uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        try:
+            arrays = {}
+            structure = self.replace_arrays(result, arrays)
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, name+'.npy'), array, allow_pickle=False)
+            with open(os.path.join(tmp_dir, 'structure.pkl'), 'wb') as f:
+                pickle.dump(structure, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = get_dir_size(tmp_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            #E.g. the entry has been added by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.get_entries()[key] = size
+        self.evict()
+
+    def replace_arrays(self, obj, arrays):
+        """Returns a copy of the structure obj in which the numpy arrays are replaced by instances of ArrayRef, while the arrays themselves are added
+        to the dictionary arrays. Arrays with dtype object can't be memory-mapped, and are kept in the structure.
+        """
+        if isinstance(obj, dict):
+            return {k: self.replace_arrays(v, arrays) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self.replace_arrays(v, arrays) for v in obj)
+        elif isinstance(obj, np.ndarray) and obj.dtype != object:
+            name = 'a%d' % len(arrays)
+            if isinstance(obj, np.ma.MaskedArray):
+                arrays[name] = obj.data
+                arrays[name+'_mask'] = np.ma.getmaskarray(obj)
+                return ArrayRef(name, True)
+            arrays[name] = obj
+            return ArrayRef(name)
+        return obj
+
+    def restore(self, obj, entry_dir):
+        """Inverse of self.replace_arrays, in which the arrays are memory-mapped from the files in entry_dir.
+        """
+        if isinstance(obj, dict):
+            return {k: self.restore(v, entry_dir) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self.restore(v, entry_dir) for v in obj)
+        elif isinstance(obj, ArrayRef):
+            array = load_array(os.path.join(entry_dir, obj.name+'.npy'))
+            if obj.masked:
+                return np.ma.MaskedArray(array, load_array(os.path.join(entry_dir, obj.name+'_mask.npy')))
+            return array
+        return obj
+
+    def get_entries(self):
+        if self.entries is None:
+            self.entries = {}
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if not name.startswith('tmp_') and os.path.isdir(path):
+                    self.entries[name] = get_dir_size(path)
+        return self.entries
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is at most self.max_size.
+        """
+        entries = self.get_entries()
+        total_size = sum(entries.values())
+        if total_size <= self.max_size:
+            return
+
+        def last_used(key):
+            try:
+                return os.stat(os.path.join(self.cache_dir, key)).st_mtime_ns
+            except OSError:
+                return 0
+        for key in sorted(entries, key=last_used):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total_size -= entries.pop(key)
+
+    def clear(self):
+        for key in list(self.get_entries()):
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        self.entries = {}
+
+
+
+def load_array(path):
+    #Arrays with size 0 can't be memory-mapped
+    array = np.load(path, mmap_mode='r')
+    return array if array.size else np.load(path)
+
+def get_dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming extraction of BUFR messages from (possibly compressed) files, and scanning of uncompressed content for messages.
+
+Instead of decompressing a complete file before decoding it, the content is decompressed in chunks with incremental decompressor objects.
+The boundaries of the messages are determined while the data arrives, using the total length of a message that is given in section 0, and the
+end marker '7777'. Each complete message is yielded as soon as it is available, after which it is removed from the buffer, such that only about
+one message needs to be kept in memory. The same scan can also yield only the start of each message (as used by headers.py), in which case the
+data of the messages in uncompressed files is skipped with seeks.
+
+Content that is already in memory (or memory-mapped) is scanned with scan_messages, which also uses the lengths of the messages to jump from one
+message to the next.
+"""
+import bz2
+import lzma
+import zlib
+import numpy as np
+
+
+
+codec_magics = {'bz2':b'BZh', 'gzip':b'\x1f\x8b', 'xz':b'\xfd7zXZ\x00'}
+decompressors = {'bz2':bz2.BZ2Decompressor, 'gzip':lambda: zlib.decompressobj(16+zlib.MAX_WBITS), 'xz':lzma.LZMADecompressor}
+
+message_index_dtype = np.dtype([('offset', 'int64'), ('length', 'int64'), ('edition', 'uint8')])
+
+def detect_codec(magic):
+    """Returns the compression codec ('bz2', 'gzip' or 'xz') that is indicated by the magic bytes at the start of a file, or None if the file is
+    not compressed (with one of these codecs).
+    """
+    for codec in codec_magics:
+        if magic.startswith(codec_magics[codec]):
+            return codec
+    return None
+
+def iter_chunks(f, chunk_size=1 << 20):
+    """Yields the content of the binary file object f in chunks, which are decompressed when the content is compressed. Files that contain multiple
+    concatenated compressed streams are supported.
+    """
+    head = f.read(8)
+    codec = detect_codec(head)
+    if codec is None:
+        yield head
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    decompressor = decompressors[codec]()
+    chunk = head
+    while chunk:
+        yield decompressor.decompress(chunk)
+        chunk = b''
+        if decompressor.eof:
+            #A new stream might follow. Anything else (e.g. padding with zeros) is ignored.
+            chunk = decompressor.unused_data
+            while len(chunk) < 8:
+                more = f.read(chunk_size)
+                if not more:
+                    break
+                chunk += more
+            if not detect_codec(chunk[:8]) == codec:
+                return
+            decompressor = decompressors[codec]()
+        else:
+            chunk = f.read(chunk_size)
+
+class ContentBuffer():
+    def __init__(self, f, chunk_size=1 << 20):
+        """Buffer with the start of the remainder of the (decompressed) content of the binary file object f, which is read in chunks with
+        iter_chunks. When f is an uncompressed file that supports seeks, then bytes that are not needed are skipped with seeks instead of being read.
+        """
+        self.f = f
+        self.chunks = iter_chunks(f, chunk_size)
+        self.buffer = bytearray()
+        self.offset = 0 #Offset of the start of the buffer in the content
+        self.can_seek = False
+        if f.seekable():
+            start = f.tell()
+            self.can_seek = detect_codec(f.read(8)) is None
+            f.seek(start)
+
+    def read_more(self):
+        #Returns False when the end of the content has been reached
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer += chunk
+        return True
+
+    def get(self, start, end):
+        """Returns the bytes from start to end (relative to the start of the buffer), or less when the content ends before end.
+        """
+        if end > len(self.buffer) and self.can_seek:
+            #The position of the file is at the end of the buffer, and is restored afterwards
+            pos = self.f.tell()
+            self.f.seek(pos+start-len(self.buffer))
+            data = self.f.read(end-start)
+            self.f.seek(pos)
+            return data
+        while len(self.buffer) < end and self.read_more():
+            pass
+        return bytes(self.buffer[start:end])
+
+    def skip(self, n_bytes):
+        """Remove the first n_bytes from the content.
+        """
+        self.offset += n_bytes
+        if n_bytes > len(self.buffer) and self.can_seek:
+            self.f.seek(n_bytes-len(self.buffer), 1)
+            self.buffer.clear()
+            return
+        while n_bytes > len(self.buffer):
+            n_bytes -= len(self.buffer)
+            self.buffer.clear()
+            if not self.read_more():
+                return
+        del self.buffer[:n_bytes]
+
+def iter_messages(f, chunk_size=1 << 20, get_prefix_size=None, max_messages=None):
+    """Yields (offset, message) for each BUFR message in the binary file object f, where message is a bytes object with the complete message, and
+    offset the byte index at which it starts in the (decompressed) content.
+    A candidate message starts with b'BUFR', followed by its total length in 3 octets. It is only accepted when it ends with b'7777', and otherwise
+    the search for the next message continues directly after the false start.
+    
+    If get_prefix_size is given, then (offset, length, prefix) is yielded instead, where length is the total length of a message and prefix only its
+    start. get_prefix_size is a function that returns the number of bytes of the prefix given the start of a message, None when more bytes are
+    needed to determine it, and 0 when the message is not valid (see headers.get_header_size). For uncompressed files the remainder of a message is
+    then skipped with seeks (see ContentBuffer), such that only the prefix and the end marker are read.
+    max_messages can be used to limit the number of messages. With get_prefix_size the end marker of the last message in compressed content is then
+    not checked, since that would require decompressing the complete message.
+    """
+    content = ContentBuffer(f, chunk_size)
+    n_messages = 0
+    while max_messages is None or n_messages < max_messages:
+        i = content.buffer.find(b'BUFR')
+        if i == -1:
+            #Keep the last 3 bytes, which might contain the start of b'BUFR'
+            content.skip(max(len(content.buffer)-3, 0))
+            if not content.read_more():
+                return
+            continue
+        content.skip(i)
+        
+        data = content.get(0, 8)
+        length = int.from_bytes(data[4:7], 'big') if len(data) == 8 else 0
+        n_prefix = length
+        if not get_prefix_size is None and length >= 12:
+            n_prefix = get_prefix_size(data)
+            while n_prefix is None and len(data) < length:
+                n_bytes = min(len(data)+chunk_size, length)
+                data = content.get(0, n_bytes)
+                if len(data) < n_bytes:
+                    break
+                n_prefix = get_prefix_size(data)
+            if n_prefix and n_messages+1 == max_messages and not content.can_seek:
+                yield content.offset, length, content.get(0, n_prefix)
+                return
+        
+        if length >= 12 and n_prefix and content.get(length-4, length) == b'7777':
+            if get_prefix_size is None:
+                yield content.offset, content.get(0, length)
+            else:
+                yield content.offset, length, content.get(0, n_prefix)
+            content.skip(length)
+            n_messages += 1
+        else:
+            #False start, or a message that is cut off at the end of the content
+            content.skip(4)
+
+def scan_messages(content):
+    """Returns a structured array with fields (offset, length, edition) for each BUFR message in content, which can be a bytes object or a memory map.
+    offset is the byte index at which a message starts, and length its total length in bytes.
+    The total length that is given in section 0 is used to jump directly to the end of a message, such that the data inside messages is not searched
+    for b'BUFR' (where it can occur by chance). Messages are accepted with the same criteria as in iter_messages, and after a false start (or a
+    corrupted message) the search continues directly after it. Between messages the content is searched for b'BUFR', since messages can be 
+    separated by e.g. bulletin headers.
+    """
+    index = []
+    n_bytes = len(content)
+    i = content.find(b'BUFR')
+    while i != -1:
+        length = int.from_bytes(content[i+4:i+7], 'big') if i+8 <= n_bytes else 0
+        if length >= 12 and i+length <= n_bytes and content[i+length-4:i+length] == b'7777':
+            index.append((i, length, content[i+7]))
+            i = content.find(b'BUFR', i+length)
+        else:
+            i = content.find(b'BUFR', i+4)
+    return np.array(index, dtype=message_index_dtype)
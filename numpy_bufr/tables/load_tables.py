@@ -30,6 +30,7 @@ Created on Sep 15, 2016
 import logging
 from .errors import BufrTableError
 from .tables import Tables
+from . import table_cache
 
 from . import parse_bufrdc, parse_eccodes, parse_libdwd
 
@@ -39,81 +40,91 @@ logger = logging.getLogger("trollbufr")
 
 
 loaded_tables = {}
+def get_table_key(meta, tab_p, tab_f):
+    """Key that identifies the set of tables referenced by the BUFR."""
+    return ','.join(list(map(str, [tab_p, tab_f, meta['master'], meta['mver'], meta['lver'], meta['center'], meta['subcenter']])))
+
 def get_tables(meta, tab_p, tab_f):
     global loaded_tables
-    """Load all tables referenced by the BUFR, if the versions differ from those already loaded."""
-    s = ','.join(list(map(str, [meta['master'], meta['mver'], meta['lver'], meta['center'], meta['subcenter']])))
+    """Load all tables referenced by the BUFR, if the versions differ from those already loaded.
+    Tables that are not yet loaded in this process are taken from the on-disk cache (see table_cache.py) when possible."""
+    s = get_table_key(meta, tab_p, tab_f)
     if not s in loaded_tables:
-        loaded_tables[s] = load_all(
-                meta['master'], meta['center'], meta['subcenter'], meta['mver'],
-                meta['lver'], tab_p, tab_f
-                )
+        args = (meta['master'], meta['center'], meta['subcenter'], meta['mver'], meta['lver'], tab_p, tab_f)
+        cache_file = None
+        if not table_cache.cache_path is None and tab_f in parse_modules:
+            try:
+                cache_file = table_cache.get_cache_file(parse_modules[tab_f], *args)
+            except Exception as e:
+                #The cache is not used, but this is not a reason for failing to load the tables
+                logger.warning("No table cache file can be determined: %s", e)
+        tables = None if cache_file is None else table_cache.load(cache_file)
+        if tables is None:
+            tables = load_all(*args)
+            if not cache_file is None:
+                #Tables B and D are always needed for decoding, and are therefore included in the cache. Other tables are loaded when accessed.
+                tables.tab_b, tables.tab_d
+                table_cache.save(cache_file, tables)
+        loaded_tables[s] = tables
     return loaded_tables[s]
 
 _text_tab_loaded = "Table loaded: '%s'"
 def load_all(master, center, subcenter, master_vers, local_vers, base_path, tabf="eccodes"):
-    """Load all given versions of tables"""
-    try:
-        tparse = parse_modules[tabf]
-    except:
+    """Load all given versions of tables.
+    The tables are loaded lazily: each table is read on first access, and code/flag tables per descriptor (see TableLoader)."""
+    if not tabf in parse_modules:
         raise BufrTableError("Unknown table parser '%s'!" % tabf)
-    tables = Tables(master, master_vers, local_vers, center, subcenter)
+    loader = TableLoader(master, center, subcenter, master_vers, local_vers, base_path, tabf)
+    return Tables(master, master_vers, local_vers, center, subcenter, loader)
+
+class TableLoader(object):
+    """Loads the tables for one set of versions into a Tables object when they are accessed.
+    Only the name of the parser is stored, such that tables can be pickled (see table_cache)."""
+    # Tables for which the local table is also loaded, and tables that are required for decoding
+    _with_local = ("B", "D", "CF")
+    _required = ("B", "D")
+
+    def __init__(self, master, center, subcenter, master_vers, local_vers, base_path, tabf):
+        self.args = (master, center, subcenter, master_vers, local_vers)
+        self.base_path = base_path
+        self.tabf = tabf
+        self.local_vers = local_vers
+
+    def _get_files(self, tabnum):
+        master, center, subcenter, master_vers, local_vers = self.args
+        return parse_modules[self.tabf].get_file(tabnum, self.base_path, master, center, subcenter, master_vers, local_vers)
 
-    # Table A (centres)
-    try:
-        mp, _ = tparse.get_file("A", base_path, master, center, subcenter, master_vers, local_vers)
-        tparse.load_tab_a(tables, mp)
-        logger.info(_text_tab_loaded, mp)
-    except Exception as e:
-        logger.warning(e)
-    #
-    # Table B (elements)
-    try:
-        mp, lp = tparse.get_file("B", base_path, master, center, subcenter, master_vers, local_vers)
-        # International (master) table
-        tparse.load_tab_b(tables, mp)
-        logger.info(_text_tab_loaded, mp)
-        # Local table
-        if local_vers:
-            tparse.load_tab_b(tables, lp)
-            logger.info(_text_tab_loaded, lp)
-    except Exception as e:
-        logger.error(e)
-        raise e
-    #
-    # Table C (operators)
-    try:
-        mp, _ = tparse.get_file("C", base_path, master, center, subcenter, master_vers, local_vers)
-        tparse.load_tab_c(tables, mp)
-        logger.info(_text_tab_loaded, mp)
-    except Exception as e:
-        logger.warning(e)
-    #
-    # Table D (sequences)
-    try:
-        mp, lp = tparse.get_file("D", base_path, master, center, subcenter, master_vers, local_vers)
-        # International (master) table
-        tparse.load_tab_d(tables, mp)
-        logger.info(_text_tab_loaded, mp)
-        # Local table
-        if local_vers:
-            tparse.load_tab_d(tables, lp)
-            logger.info(_text_tab_loaded, lp)
-    except Exception as e:
-        logger.error(e)
-        raise e
-    #
-    # Table CF (code/flags)
-    try:
-        mp, lp = tparse.get_file("CF", base_path, master, center, subcenter, master_vers, local_vers)
-        # International (master) table
-        tparse.load_tab_cf(tables, mp)
-        logger.info(_text_tab_loaded, mp)
-        # Local table
-        if local_vers:
-            tparse.load_tab_cf(tables, lp)
-            logger.info(_text_tab_loaded, lp)
-    except Exception as er:
-        logger.warning(er)
+    def load(self, tables, tabnum):
+        """Load table tabnum ('A', 'B', 'C', 'D' or 'CF') into tables."""
+        tparse = parse_modules[self.tabf]
+        load_tab = getattr(tparse, "load_tab_" + tabnum.lower())
+        try:
+            mp, lp = self._get_files(tabnum)
+            # International (master) table
+            load_tab(tables, mp)
+            logger.info(_text_tab_loaded, mp)
+            # Local table
+            if self.local_vers and tabnum in self._with_local:
+                load_tab(tables, lp)
+                logger.info(_text_tab_loaded, lp)
+        except Exception as e:
+            if tabnum in self._required:
+                logger.error(e)
+                raise e
+            logger.warning(e)
 
-    return tables
\ No newline at end of file
+    def load_cf(self, tables, descr):
+        """Load the code/flag table for descriptor descr into tables, if the parser can load single code/flag tables.
+        Otherwise all code/flag tables are loaded. Returns True in the latter case."""
+        tparse = parse_modules[self.tabf]
+        if not hasattr(tparse, "load_tab_cf_descr"):
+            self.load(tables, "CF")
+            return True
+        try:
+            mp, lp = self._get_files("CF")
+            tparse.load_tab_cf_descr(tables, mp, descr)
+            if self.local_vers:
+                tparse.load_tab_cf_descr(tables, lp, descr)
+        except Exception as e:
+            logger.warning(e)
+        return False
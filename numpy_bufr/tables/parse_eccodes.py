@@ -180,20 +180,34 @@ def load_tab_cf(tables, fname):
     if not os.path.exists(fname):
         raise BufrTableError(_text_file_not_found % fname)
     for fn_etab in glob.glob(os.path.join(fname, "*.table")):
-        desc = os.path.basename(fn_etab).split('.')
-        with open(fn_etab, "r") as fh:
-            for line in fh:
-                if line.startswith('#') or len(line) < 3:
-                    continue
-                try:
-                    e = line.rstrip().split(' ', 2)
-                    if e[2].startswith("Reserved") or e[2].startswith("Not used"):
-                        continue
-                    tables.tab_cf.setdefault(int(desc[0]), {})[int(e[0])] = e[2].replace("\"    ", "")
-                except IndexError:
-                    logger.warn("Table parse: no values: '%s' in '%s'", line.strip(), fn_etab)
+        _load_tab_cf_file(tables, fn_etab)
+    return True
+
+def load_tab_cf_descr(tables, fname, descr):
+    """
+    Load the code- or flagtable for one descriptor into object Tables.
+    For ecCodes each table is a separate file in directory fname, and only
+    that file is read. A missing file means there is no table for descr.
+    """
+    fn_etab = os.path.join(fname, "%d.table" % descr)
+    if os.path.exists(fn_etab):
+        _load_tab_cf_file(tables, fn_etab)
     return True
 
+def _load_tab_cf_file(tables, fn_etab):
+    desc = os.path.basename(fn_etab).split('.')
+    with open(fn_etab, "r") as fh:
+        for line in fh:
+            if line.startswith('#') or len(line) < 3:
+                continue
+            try:
+                e = line.rstrip().split(' ', 2)
+                if e[2].startswith("Reserved") or e[2].startswith("Not used"):
+                    continue
+                tables.tab_cf.setdefault(int(desc[0]), {})[int(e[0])] = e[2].replace("\"    ", "")
+            except IndexError:
+                logger.warn("Table parse: no values: '%s' in '%s'", line.strip(), fn_etab)
+
 def get_file(tabnum, base_path, master, center, subcenter, master_vers, local_vers):
     mp = os.path.join(base_path, str(master), "wmo", str(master_vers))
     lp = os.path.join(base_path, str(master), "local", str(local_vers), str(center), str(subcenter))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of parsed tables.
+
+Parsing the text files of a set of tables takes much longer than decoding a typical message, especially for ecCodes tables, where each code/flag
+table is given in a separate file. Tables that are loaded within a process are kept in load_tables.loaded_tables, but every new process (e.g. each
+worker in parallel.py) would still need to parse them again. Therefore the parsed tables (a Tables object) are also pickled into a single file in
+the directory cache_path, from which they are loaded by later processes.
+
+The name of a cache file is a hash of the table type, the table path, the master table/centre/subcentre/versions, and the modification times and
+sizes of all source files of the tables. A cache file therefore automatically becomes unused when one of the source files is changed, added or
+removed. Set cache_path to None (or the environment variable NUMPY_BUFR_TABLE_CACHE to an empty string) to disable the cache.
+"""
+import os
+import glob
+import pickle
+import hashlib
+import logging
+
+logger = logging.getLogger("trollbufr")
+
+
+
+cache_path = os.environ.get('NUMPY_BUFR_TABLE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'numpy_bufr', 'tables')) or None
+cache_version = 4 #Should be increased when the structure of the Tables object changes, such that old cache files are not used anymore
+
+def get_source_files(tparse, base_path, master, center, subcenter, master_vers, local_vers):
+    """Returns the paths of all files from which the tables are loaded. For table CF a directory can be given (ecCodes), in which case its files
+    are included. Tables for which the parser can't determine the file names (e.g. table A for bufrdc) are skipped.
+    """
+    source_files = []
+    for tabnum in ('A', 'B', 'C', 'D', 'CF'):
+        try:
+            paths = tparse.get_file(tabnum, base_path, master, center, subcenter, master_vers, local_vers)
+        except Exception:
+            continue
+        for path in paths:
+            if os.path.isdir(path):
+                source_files += sorted(glob.glob(os.path.join(path, '*')))
+            else:
+                source_files.append(path)
+    return source_files
+
+def get_cache_file(tparse, master, center, subcenter, master_vers, local_vers, base_path, tabf):
+    """Returns the path of the cache file for the tables, with the same arguments as load_tables.load_all (and the parser module tparse).
+    """
+    source_stats = []
+    for path in get_source_files(tparse, base_path, master, center, subcenter, master_vers, local_vers):
+        try:
+            stat = os.stat(path)
+            source_stats.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            source_stats.append((path, None, None)) #The file doesn't exist
+    key = repr((cache_version, tabf, os.path.abspath(base_path), master, center, subcenter, master_vers, local_vers, source_stats))
+    return os.path.join(cache_path, hashlib.sha1(key.encode('utf-8')).hexdigest()+'.pickle')
+
+def load(cache_file):
+    """Returns the tables stored in cache_file, or None if the file doesn't exist (or can't be read).
+    """
+    if cache_path is None or not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning("Table cache file '%s' can't be read: %s", cache_file, e)
+        return None
+
+def save(cache_file, tables):
+    if cache_path is None:
+        return
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        #Write to a temporary file first, such that other processes never read a partially written file
+        tmp_file = cache_file+'.%d.tmp' % os.getpid()
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        logger.warning("Tables can't be written to the cache: %s", e)
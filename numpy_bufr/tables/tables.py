@@ -29,30 +29,57 @@ Created on Sep 15, 2016
 '''
 
 import logging
+import numpy as np
 logger = logging.getLogger("trollbufr")
 
 class Tables(object):
     # Recocnized types
     type_list = ("double", "long", "string", "code", "flag")
 
-    def __init__(self, master=0, master_vers=0, local_vers=0, centre=0, subcentre=0):
-        '''Constructor'''
+    def __init__(self, master=0, master_vers=0, local_vers=0, centre=0, subcentre=0, loader=None):
+        '''Constructor
+        If a loader is given (see load_tables.TableLoader), then each table is loaded on first access, 
+        and code/flag tables are loaded per descriptor.'''
         self._master = master
         self._vers_master = master_vers
         self._vers_local = local_vers
         self._centre = centre
         self._centre_sub = subcentre
+        self._loader = loader
+        self._loaded = set()
         
         # { code -> meaning }
-        self.tab_a = dict()
-        # { desc -> TabBelem }
-        self.tab_b = dict()
+        self._tab_a = dict()
+        # { desc -> TabBelem }, stored in columns (see TableB)
+        self._tab_b = TableB()
         # { desc -> (name, definition) }
-        self.tab_c = dict()
+        self._tab_c = dict()
         # { desc -> (desc, ...) }
-        self.tab_d = dict()
+        self._tab_d = dict()
         # { desc -> {num:value} }
-        self.tab_cf = dict()
+        self._tab_cf = TableCF(self)
+        # { desc -> compiled code/flag table, see _compile_codeflag }
+        self._cf_compiled = dict()
+        # { desc -> (expanded descriptors, source sequences), see expand_sequence }
+        self._tab_d_expanded = dict()
+
+    def _get_table(self, tabnum):
+        if not tabnum in self._loaded:
+            # Marked as loaded first, because the parser fills the table through the same property
+            self._loaded.add(tabnum)
+            if self._loader is not None:
+                try:
+                    self._loader.load(self, tabnum)
+                except Exception:
+                    self._loaded.discard(tabnum)
+                    raise
+        return getattr(self, "_tab_" + tabnum.lower())
+
+    tab_a = property(lambda self: self._get_table("A"))
+    tab_b = property(lambda self: self._get_table("B"))
+    tab_c = property(lambda self: self._get_table("C"))
+    tab_d = property(lambda self: self._get_table("D"))
+    tab_cf = property(lambda self: self._tab_cf)
 
 
     def lookup_codeflag(self, descr, val):
@@ -78,6 +105,104 @@ class Tables(object):
                 logger.debug("FLAG %06d: %d -> %s", descr, val, sval)
         return sval or "N/A"
 
+    def lookup_codeflag_array(self, descr, values):
+        """Vectorized version of lookup_codeflag, for an array of values.
+        Returns (codes, labels), where labels is an array with the distinct
+        meanings (including "N/A" for values without meaning and missing
+        values), and codes an integer array with the shape of values that
+        gives the index in labels for each value.
+        If descr has no code/flag table, then (values, None) is returned.
+        """
+        if not isinstance(descr, int):
+            descr = int(descr)
+        masked = np.ma.getmaskarray(values) # Masked values (missing='mask') are missing as well
+        values = np.asarray(values)
+        if descr >= 100000 or not self.tab_cf.get(descr):
+            return values, None
+        if descr not in self._cf_compiled:
+            self._cf_compiled[descr] = self._compile_codeflag(descr)
+        typ, table, labels = self._cf_compiled[descr]
+
+        # Missing values (NaN or masked) and negative values get no meaning
+        valid = np.isfinite(values) if values.dtype.kind == 'f' else np.ones(values.shape, dtype=bool)
+        valid &= ~masked
+        ints = np.where(valid, values, -1).astype('int64')
+        valid &= ints >= 0
+        if typ == "code":
+            valid &= ints < len(table)
+            codes = np.full(values.shape, np.flatnonzero(labels == "N/A")[0], dtype='int32')
+            codes[valid] = table[ints[valid]]
+            return codes, labels
+        # Flag table: the meaning of each distinct combination of bits is determined once
+        uniq, inverse = np.unique(ints[valid], return_inverse=True)
+        bits_set = (uniq[:, np.newaxis] & table[1]) != 0
+        uniq_labels = ["|".join(labels[table[0][bits]]) or "N/A" for bits in bits_set]
+        labels, uniq_codes = np.unique(np.array(["N/A"] + uniq_labels), return_inverse=True)
+        codes = np.full(values.shape, uniq_codes[0], dtype='int32')
+        codes[valid] = uniq_codes[1:][inverse.ravel()]
+        return codes, labels
+
+    def _compile_codeflag(self, descr):
+        """Returns (typ, table, labels) for a code or flag table.
+        For a code table, table is a dense array that gives for each value
+        the index of its meaning in labels (or of "N/A").
+        For a flag table, table contains for each flag the index of its
+        meaning in labels, and the bit mask of the flag.
+        """
+        b = self.tab_b[descr]
+        cf = self.tab_cf[descr]
+        if b.typ == "flag":
+            flags = [k for k in sorted(cf) if 1 <= k <= b.width]
+            labels = np.array([cf[k] for k in flags])
+            masks = np.array([1 << (b.width - k) for k in flags], dtype='int64')
+            return "flag", (np.arange(len(flags)), masks), labels
+        nums = np.array([k for k in sorted(cf) if k >= 0], dtype='int64')
+        labels, index = np.unique(np.array(["N/A"] + [cf[k] for k in nums]), return_inverse=True)
+        table = np.full(nums.max() + 1 if len(nums) else 0, index[0], dtype='int32')
+        table[nums] = index[1:]
+        return "code", table, labels
+
+    def expand_sequence(self, descr):
+        """Returns the fully expanded sequence for table D descriptor descr
+        (an integer FXXYYY), in which nested sequence descriptors are
+        replaced recursively. Returns (expanded, source), where expanded
+        is an integer array with the descriptors, and source gives for
+        each descriptor the sequence in which it is directly listed.
+        The expansion is done once per sequence, and cached.
+        """
+        if descr not in self._tab_d_expanded:
+            parts, sources = [], []
+            for d in self.tab_d[descr]:
+                if d // 100000 == 3:
+                    e, s = self.expand_sequence(d)
+                    parts.append(e)
+                    sources.append(s)
+                else:
+                    parts.append((d,))
+                    sources.append((descr,))
+            expanded = np.concatenate(parts + [()]).astype('int64')
+            source = np.concatenate(sources + [()]).astype('int64')
+            expanded.flags.writeable = source.flags.writeable = False
+            self._tab_d_expanded[descr] = (expanded, source)
+        return self._tab_d_expanded[descr]
+
+    def expand_descriptors(self, descr):
+        """Replace all sequence descriptors in the array descr by their
+        expanded sequences (see expand_sequence), with one concatenation.
+        Returns (expanded, source), where source is -1 for descriptors
+        that are not part of a sequence.
+        """
+        parts, sources = [], []
+        for d in np.asarray(descr).tolist():
+            if d // 100000 == 3:
+                e, s = self.expand_sequence(d)
+                parts.append(e)
+                sources.append(s)
+            else:
+                parts.append((d,))
+                sources.append((-1,))
+        return np.concatenate(parts + [()]).astype('int64'), np.concatenate(sources + [()]).astype('int64')
+
     def lookup_elem(self, descr):
         """Returns name und unit associated with table B or C descriptor."""
         if descr < 100000:
@@ -103,7 +228,128 @@ class Tables(object):
         return a or "UNKN"
 
 
+class TableB(object):
+    """Table B, stored as columns: a sorted array of descriptors, with parallel arrays for the type (an index in Tables.type_list), width, scale,
+    refval, unit, abbreviation and name.
+    Entries are added like in a dict, i.e. with tables.tab_b[descr] = TabBelem(...), where an entry for an existing descriptor replaces it (as
+    happens for a local table). Added entries are merged into the columns at the first lookup after adding them.
+    Looking up a single descriptor returns a TabBelem, which is created from the columns. Many descriptors are looked up at once with 
+    self.get_rows, which uses one np.searchsorted for all of them.
+    """
+    columns = ('typ', 'width', 'scale', 'refval', 'unit', 'abbrev', 'full_name')
+    
+    def __init__(self):
+        self.descr = np.zeros(0, dtype='int64')
+        self.typ = np.zeros(0, dtype='uint8')
+        self.width = np.zeros(0, dtype='int64')
+        self.scale = np.zeros(0, dtype='int64')
+        self.refval = np.zeros(0, dtype='int64')
+        self.unit = np.zeros(0, dtype=object)
+        self.abbrev = np.zeros(0, dtype=object)
+        self.full_name = np.zeros(0, dtype=object)
+        self.new_entries = {}
+        
+    def __setitem__(self, descr, elem):
+        self.new_entries[descr] = elem
+        
+    def merge_new_entries(self):
+        if not self.new_entries:
+            return
+        new_descr = np.array(list(self.new_entries), dtype='int64')
+        new_columns = {
+            'typ':np.array([Tables.type_list.index(e.typ) for e in self.new_entries.values()], dtype='uint8'),
+            'width':np.array([e.width for e in self.new_entries.values()], dtype='int64'),
+            'scale':np.array([e.scale for e in self.new_entries.values()], dtype='int64'),
+            'refval':np.array([e.refval for e in self.new_entries.values()], dtype='int64')}
+        for c in ('unit', 'abbrev', 'full_name'):
+            new_columns[c] = np.empty(len(new_descr), dtype=object)
+            new_columns[c][:] = [getattr(e, c) for e in self.new_entries.values()]
+        self.new_entries = {}
+        
+        keep = ~np.isin(self.descr, new_descr) #Existing entries that are not replaced
+        descr = np.concatenate([self.descr[keep], new_descr])
+        order = np.argsort(descr, kind='stable')
+        self.descr = descr[order]
+        for c in self.columns:
+            setattr(self, c, np.concatenate([getattr(self, c)[keep], new_columns[c]])[order])
+        
+    def get_rows(self, descrs):
+        """Returns the row in the columns for each descriptor in descrs (an array or list of integers), or -1 for descriptors that are not present.
+        """
+        self.merge_new_entries()
+        descrs = np.asarray(descrs, dtype='int64')
+        rows = np.searchsorted(self.descr, descrs)
+        rows[rows == len(self.descr)] = 0
+        if len(self.descr):
+            rows[self.descr[rows] != descrs] = -1
+        else:
+            rows[:] = -1
+        return rows
+    
+    def get_elem(self, row):
+        return TabBelem(int(self.descr[row]), Tables.type_list[self.typ[row]], self.unit[row], self.abbrev[row], self.full_name[row], 
+                        int(self.scale[row]), int(self.refval[row]), int(self.width[row]))
+        
+    def __getitem__(self, descr):
+        row = self.get_rows([descr])[0]
+        if row == -1:
+            raise KeyError(descr)
+        return self.get_elem(row)
+    
+    def get(self, descr, default=None):
+        row = self.get_rows([descr])[0]
+        return default if row == -1 else self.get_elem(row)
+    
+    def __contains__(self, descr):
+        return self.get_rows([descr])[0] != -1
+    
+    def __len__(self):
+        self.merge_new_entries()
+        return len(self.descr)
+    
+    def __iter__(self):
+        self.merge_new_entries()
+        return iter(self.descr.tolist())
+    
+    def __getstate__(self):
+        self.merge_new_entries()
+        return self.__dict__
+    
+
+class TableCF(dict):
+    """Code/flag tables { desc -> {num:value} }, of which the table for a descriptor is loaded on first access to that descriptor.
+    For ecCodes only the file for that descriptor is read, while for other table formats (with all code/flag tables in one file) the complete 
+    table is loaded at once.
+    """
+    def __init__(self, tables):
+        dict.__init__(self)
+        self.tables = tables
+        self.loaded_descrs = set()
+        self.all_loaded = False
+        
+    def load(self, descr):
+        loader = self.tables._loader
+        if self.all_loaded or loader is None or descr in self.loaded_descrs:
+            return
+        self.loaded_descrs.add(descr)
+        self.all_loaded = loader.load_cf(self.tables, descr)
+        
+    def get(self, descr, default=None):
+        self.load(descr)
+        return dict.get(self, descr, default)
+    
+    def __getitem__(self, descr):
+        self.load(descr)
+        return dict.__getitem__(self, descr)
+    
+    def __contains__(self, descr):
+        self.load(descr)
+        return dict.__contains__(self, descr)
+    
+
 class TabBelem(object):
+    __slots__ = ('descr', 'typ', 'unit', 'abbrev', 'full_name', 'scale', 'refval', 'width')
+    
     def __init__(self, descr, typ, unit, abbrev, full_name, scale, refval, width):
         _type_dwd = { "A":'string', "N":"???", "C":"code", "F":"flag"}
         self.descr = descr